@@ -0,0 +1,193 @@
+"""Scale benchmarks against a local Snowflake stand-in
+
+Builds synthetic SQI tables in a local DuckDB database at each scale, then times loading, processing and response
+normalization against it, with a recorded (or synthetic) Yext client instead of the Answers API. Needs duckdb.
+
+    python benchmark.py --scales 10000 1000000 10000000 --output benchmark.json
+    python benchmark.py --scales 10000 1000000 --baseline benchmark.json --tolerance 1.25
+
+With --baseline, exits with an error when any stage is more than --tolerance times slower than in the baseline.
+Exits with an error as well when searches with identical results aren't stored once by the response cache.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+from utils import cache, clustering, loading, local, processing, responses, snowflake
+
+SORT_ORDERS = ["By SQI (Ascending)", "By Searches (Descending)"]
+# The business and experience every experience level stage is timed on
+BUSINESS = "Business 1"
+EXPERIENCE = "experience-1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 1_000_000], help="Searches per run")
+    parser.add_argument("--businesses", type=int, default=local.BUSINESSES, help="Number of businesses")
+    parser.add_argument(
+        "--experiences", type=int, default=local.EXPERIENCES_PER_BUSINESS, help="Experiences per business"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=local.QUERIES_PER_EXPERIENCE, help="Distinct queries per experience"
+    )
+    parser.add_argument("--lookback", type=int, default=14, help="Lookback period in days, maximum 30")
+    parser.add_argument("--percentile", type=float, default=0.9, help="Min. searches threshold, as a percentile")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each stage")
+    parser.add_argument("--responses", help="JSONL of recorded responses, see utils/local.record_responses")
+    parser.add_argument("--entities", type=int, default=50, help="Results per vertical of synthetic responses")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--output", default="benchmark.json", help="Path of the JSON results")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="Allowed slowdown against the baseline")
+    return parser.parse_args()
+
+
+# Time fn over `repeat` runs. `setup` is run untimed before each run, e.g. to empty a cache
+def timed(fn, repeat, setup=None) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    rows = len(result.index) if isinstance(result, pd.DataFrame) else None
+    return {"seconds": seconds, "min": min(seconds), "median": statistics.median(seconds), "rows": rows}
+
+
+# Point the process-wide result cache at a new, empty directory
+def clear_result_cache(directory):
+    cache._CACHE = cache.ResultCache(tempfile.mkdtemp(dir=directory))
+
+
+def run_scale(args, searches, cache_dir) -> dict:
+    conn = local.LocalConnection()
+    start = time.perf_counter()
+    local.create_tables(conn, searches, args.businesses, args.experiences, args.queries, seed=args.seed)
+    generate_seconds = time.perf_counter() - start
+    stages = {}
+
+    def load_queries():
+        return loading.query_level_sqi(BUSINESS, EXPERIENCE, args.lookback, conn)
+
+    def load_global():
+        return loading.global_sqi(args.lookback, conn)
+
+    def cold():
+        loading.clear_stores()
+        clear_result_cache(cache_dir)
+
+    # Cold loads query the local engine, cached loads read the result cache and warm loads only roll up the store
+    stages["query_level_sqi.cold"] = timed(load_queries, args.repeat, cold)
+    stages["query_level_sqi.cached"] = timed(load_queries, args.repeat, loading.clear_stores)
+    stages["query_level_sqi.warm"] = timed(load_queries, args.repeat)
+    stages["global_sqi.cold"] = timed(load_global, args.repeat, cold)
+    stages["global_sqi.cached"] = timed(load_global, args.repeat, loading.clear_stores)
+    stages["global_sqi.warm"] = timed(load_global, args.repeat)
+
+    df = load_queries()
+    for sort_index in SORT_ORDERS:
+        name = sort_index.split()[1].lower()
+        stages[f"processing.filter_sort.{name}"] = timed(
+            lambda: processing.sort_df(
+                df[df["total_searches"] >= processing.searches_floor(df, "total_searches", args.percentile)],
+                sort_index,
+            ),
+            args.repeat,
+        )
+        stages[f"processing.view_index.{name}"] = timed(
+            lambda: df.iloc[processing.ViewIndex(df).rows(args.percentile, sort_index)], args.repeat
+        )
+    stages["clustering.cluster_queries"] = timed(lambda: clustering.cluster_queries(df["query"], df["total_searches"]), args.repeat)
+
+    if args.responses:
+        client = local.RecordedYextClient.from_jsonl(args.responses, entities=args.entities)
+    else:
+        client = local.RecordedYextClient(entities=args.entities)
+    queries = list(df["query"].head(args.repeat))
+
+    def normalize():
+        for query in queries:
+            raw_response = processing.return_raw_response(client, query, EXPERIENCE)
+            normalized = processing.normalize_response(processing.cleaned_response(raw_response))
+            for i, (vertical, _) in enumerate(normalized.modules):
+                fields = normalized.link_fields if vertical == "Links" else normalized.fields
+                normalized.cards(i, fields)
+
+    stages["processing.normalize_response"] = timed(normalize, args.repeat)
+    conn.close()
+    return {"searches": searches, "queries": len(df.index), "generate_seconds": generate_seconds, "stages": stages}
+
+
+# Check that two searches with the same results, differing only in their IDs, are stored in the response cache as
+# a single payload and read back with their own IDs. Returns a description of the first problem found, if any
+def check_response_dedupe(client, directory):
+    response_cache = responses.ResponseCache(directory)
+    searches = [processing.return_raw_response(client, "search term 1", EXPERIENCE) for _ in range(2)]
+    for i, search in enumerate(searches):
+        response_cache.put(str(i), search)
+    blobs = os.listdir(os.path.join(directory, "blobs"))
+    if len(blobs) != 1:
+        return f"two searches with identical results were stored as {len(blobs)} payloads"
+    for i, search in enumerate(searches):
+        cached = response_cache.get(str(i))
+        if cached is None or cached["query_id"] != search["query_id"]:
+            return f"search {i} wasn't read back with its own query ID"
+        if cached["raw_response"]["response"] is not cached["response"]:
+            return f"search {i} wasn't read back with raw_response.response as its response"
+    return None
+
+
+# Stages more than `tolerance` times slower than in the baseline, at the scales both runs have
+def regressions(results, baseline, tolerance) -> list:
+    baseline_runs = {run["searches"]: run["stages"] for run in baseline["runs"]}
+    slower = []
+    for run in results["runs"]:
+        for stage, timing in run["stages"].items():
+            previous = baseline_runs.get(run["searches"], {}).get(stage)
+            if previous and timing["min"] > previous["min"] * tolerance:
+                slower.append((run["searches"], stage, previous["min"], timing["min"]))
+    return slower
+
+
+def main():
+    args = parse_args()
+    snowflake.configure_logging()
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "args": vars(args),
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as cache_dir:
+        problem = check_response_dedupe(local.RecordedYextClient(), tempfile.mkdtemp(dir=cache_dir))
+        if problem:
+            sys.exit(f"Response cache check failed: {problem}")
+        for searches in args.scales:
+            snowflake.LOGGER.info("Benchmarking %s searches", searches)
+            results["runs"].append(run_scale(args, searches, cache_dir))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    for run in results["runs"]:
+        for stage, timing in run["stages"].items():
+            print(f"{run['searches']:>12,} {stage:<40} {timing['min']:>10.4f}s")
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for searches, stage, before, after in slower:
+            print(f"Regression at {searches:,} searches: {stage} took {after:.4f}s, was {before:.4f}s")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,117 @@
 """Demo Streamlit app for in-platform SQI
 """
+import logging
+from concurrent.futures import FIRST_COMPLETED
+
 import streamlit as st
-from utils import loading, snowflake, processing
+from utils import datasets, debug, loading, paging, sidebar, snowflake, telemetry
+
+LOGGER = logging.getLogger(__name__)
 
 st.set_page_config(page_title="Search Term SQI", page_icon="gear")
 st.title("In-Platform SQI")
+# Time every stage of this render, for the debug panel and the logs
+TRACE = telemetry.start_trace("demo")
 
-FILEPATH = "/Users/cxi/datascience/new-sqi-prototype/sqi_business_experience.csv"
+# Maximum time in seconds for any single Snowflake query of a page render
+QUERY_TIMEOUT = 120
 
 st.markdown(
     """
     This app allows lets you pull search quality data from Snowflake by specifying filters such as business name, experience key and lookback period - without having to write a single SQL query.
     """
 )
-# Initialize user inputs in a sidebar
-with st.sidebar:
-    # Number input for lookback period, maximum 30 days
-    st.write("Select a lookback period")
-    lookback = st.sidebar.number_input(
-        "Lookback Period (Days)",
-        min_value=0,
-        max_value=30,
-        value=14,
-        step=1,
-        help="Maximum 30 days",
-    )
-    st.sidebar.write("Select a business and experience")
-    # Load all options for business selection from a .csv file containing all businesses and experiences with an SQI score in October 2022
-    businesses = loading.initialize_businesses(FILEPATH)
-    unique_businesses = businesses.business_name.unique()
-    # Business user input
-    business_name = st.sidebar.selectbox("Business Name", options=unique_businesses)
-    # Fetch the business ID, used to grab the API key for connecting with the Yext Client
-    user_business_id = loading.filter_businessid(businesses, business_name)
-    # Load all experiences for a particular business from a .csv file containing all businesses and experiences with an SQI score in October 2022, given the business name the user inputted above
-    experiences = loading.filter_experiences(businesses, business_name)
-    unique_experiences = experiences.experience_key.unique()
-    # User input for experience
-    experience_key = st.sidebar.selectbox("Experience Key", options=experiences["experience_key"])
-    # Allow user to select the sort order of the table. Defaults to SQI ascending
-    table_sort_order = st.selectbox(
-        "Table Sort Order",
-        options=["By SQI (Ascending)", "By Searches (Descending)"],
-        help="Select a column to sort table by. Sort by either SQI (ascending) or searches (descending). Defaults to SQI ascending.",
+# Snowflake connection shared by every session, only opened once the first query needs it
+CONN = snowflake.get_connection()
+
+# Initialize user inputs in a sidebar, shared with the other pages
+selection = sidebar.render_sidebar(CONN, show_sort_order=True)
+business_name = selection.business_name
+experience_key = selection.experience_key
+lookback = selection.lookback
+table_sort_order = selection.table_sort_order
+searches_percentile = selection.searches_percentile
+show_timings = debug.debug_toggle()
+fast_preview = st.sidebar.checkbox(
+    "Fast preview",
+    value=True,
+    key="fast_preview",
+    help="Show approximate SQI for the worst queries from a sample of searches while the exact table loads.",
+)
+
+
+# Render the approximate worst queries and experience SQI, with their 95% confidence intervals
+def render_preview(preview_df):
+    st.info(f"Preview from a {loading.PREVIEW_SAMPLE_PERCENT:g}% sample of searches, loading the exact table...")
+    if preview_df.empty:
+        st.write("No searches in the sample.")
+        return
+    col1, col2 = st.columns(2)
+    col1.metric(
+        "Avg. Experience SQI (approx.)",
+        value=f"{preview_df['avg_experience_sqi'][0]} ± {preview_df['avg_experience_sqi_error'][0]}",
     )
-    # Allow user to select the minimum searches threshold for the table, using percentiles. This is to filter out long-tail queries. Defaults to 0.99
-    st.sidebar.write("Select a search threshold")
-    searches_percentile = st.slider(
-        "Min. Searches Threshold",
-        min_value=0.0,
-        max_value=1.0,
-        value=0.99,
-        step=0.01,
-        help="Select a minimum search volume threshold, represented by percentile of total searches, for queries to view SQI for.",
+    col2.metric("Queries in sample (approx.)", value=int(preview_df["sampled_queries"][0]))
+    preview_table = preview_df[["query", "query_sqi_score", "query_sqi_error", "total_searches", "total_searches_error"]]
+    st.dataframe(
+        preview_table.rename(columns={"query_sqi_error": "± query_sqi_score", "total_searches_error": "± total_searches"}),
+        use_container_width=True,
     )
 
-# Connect to Snowflake
-@st.experimental_singleton()
-def connect_to_snowflake():
-    return snowflake.connect_to_snowflake()
 
-
-CONN = connect_to_snowflake()
+# Load the table containing all queries and SQI scores, and the global SQI, at the same time
+# The table is shared with the other pages, so it's only loaded if no page has loaded it this session
+# Queries still running from a previous render with different inputs are cancelled
+key = datasets.dataset_key(business_name, experience_key, lookback)
+dataset = datasets.get_dataset(st.session_state, key)
+calls = {"global_sqi": (loading.global_sqi, lookback, CONN)}
+if dataset is None:
+    calls["query_level_sqi"] = (loading.query_level_sqi, business_name, experience_key, lookback, CONN)
+# A sampled preview is only worth it when the exact table has to be fetched from Snowflake
+preview = fast_preview and dataset is None and not loading.query_level_sqi_loaded(business_name, experience_key)
+scope = snowflake.query_scope(st.session_state, key, QUERY_TIMEOUT)
+placeholder = st.empty()
+try:
+    futures = snowflake.submit_concurrently(calls, scope)
+    if preview:
+        # The preview runs in a scope of its own, so its query can be cancelled without the others
+        preview_scope = scope.child()
+        preview_call = (loading.preview_query_sqi, business_name, experience_key, lookback, searches_percentile, CONN)
+        preview_future = snowflake.submit_concurrently({"preview": preview_call}, preview_scope)["preview"]
+        # Show the preview until the exact table arrives, unless the exact table is ready first
+        done, _ = snowflake.wait_for([preview_future, futures["query_level_sqi"]], FIRST_COMPLETED)
+        if futures["query_level_sqi"] in done:
+            preview_scope.cancel()
+        elif preview_future.exception() is not None:
+            error = preview_future.exception()
+            LOGGER.warning("Preview of %s / %s failed: %s", business_name, experience_key, error, exc_info=error)
+        else:
+            with placeholder.container():
+                render_preview(preview_future.result())
+    results = snowflake.gather(futures)
+except snowflake.QueryCancelled as error:
+    st.warning(f"Loading SQI data was stopped: {error}")
+    st.stop()
+# Swap the preview out for the exact table
+placeholder.empty()
+if dataset is None:
+    dataset = datasets.put_dataset(st.session_state, key, results["query_level_sqi"])
 # Initialize tabs - one containing the search terms table, the other with the source Snowflake query
 tab1, tab2 = st.tabs(["Search Terms Table", "Snowflake Query"])
 with tab1:
-    # Load table containing all queries and SQI scores
-    query_level_sqi = loading.query_level_sqi(business_name, experience_key, lookback, CONN)
-    # Cleaning the dataframe of queries to display as a table
-    # Drop unneccessary columns
-    display_df = query_level_sqi.drop(
-        columns=["business_name", "business_id", "experience_key", "avg_experience_sqi"]
-    )
-    display_df = display_df.reset_index(drop=True)
-    # Establish a minimum searches threshold, based on the user inputted percentile and the search volume of the experience
-    min_searches = int(
-        round(processing.searches_floor(display_df, "total_searches", searches_percentile), 0)
-    )
-    # filter out any queries that do not meet the minimum searches threshold
-    display_df = display_df[display_df["total_searches"] >= min_searches]
-    # Sort the table based on the sort order selected by the user
-    display_df = processing.sort_df(display_df, table_sort_order)
     # Hero number columns
     try:
         # Initialize columns for the hero numbers
         col1, col2, col3 = st.columns(3)
         # Average SQI for this experience for the given date range
-        # Take the first value from the column since they're all the same
-        experience_sqi = query_level_sqi["avg_experience_sqi"][0]
+        experience_sqi = dataset.experience_sqi
         col1.metric(
             "Avg. Experience SQI",
             value=experience_sqi,
             help="This is the average SQI score across this experience for the given lookback.",
         )
         # Get the global SQI (Average SQI across all experiences) for a given lookback period
-        load_sqi = loading.global_sqi(lookback, CONN)
+        load_sqi = results["global_sqi"]
         # Take the first value from the column since they're all the same
         global_sqi = load_sqi["query_sqi_score"][0]
         col2.metric(
@@ -103,15 +120,43 @@ with tab1:
             help="This is the average SQI across every experience for the given lookback",
         )
         # Display the table containing queries, searches, SQI, and performance (above, at, or below average)
-        st.dataframe(display_df, use_container_width=True)
+        # Queries above the minimum searches threshold, sorted based on the sort order selected by the user, a page at a time
+        group_queries = st.checkbox(
+            "Group near-duplicate queries",
+            key="group_queries",
+            help="Groups queries with nearly the same text, so long-tail variants count towards the threshold together.",
+        )
+        if group_queries:
+            clusters = dataset.cluster_view(searches_percentile, table_sort_order)
+            paging.render_paged_frame(clusters, key="clusters", noun="groups")
+            st.caption(f"{len(clusters.index)} groups of {len(dataset.display.index)} queries")
+        else:
+            paging.render_paged_table(dataset, searches_percentile, table_sort_order)
     # If there is no data in the table, throw an IndexError to the user telling them to select a new date period
     except IndexError:
         st.write("No data found for this lookback period. Please select a different period.")
 
 with tab2:
     # Raw Snowflake query
-    raw_query = loading.return_query(loading.QUERY, business_name, experience_key, lookback)
+    raw_query = loading.return_query(
+        *loading.build_query_level_sql(
+            business_name, experience_key, lookback, searches_percentile, table_sort_order
+        )
+    )
     st.header("Snowflake Query")
-    st.write("In case you wanted to query the data yourself!")
+    st.write(
+        "In case you wanted to query the data yourself! This standalone query gives the same table as the first tab. "
+        "The app itself loads per-day aggregates of the experience once, then applies the lookback, searches "
+        "threshold and sort order locally."
+    )
     with st.expander("View Query"):
         st.code(raw_query, language="sql")
+    with st.expander("View query run by the app"):
+        st.code(
+            loading.return_query(*loading.build_daily_sql(business_name, experience_key)),
+            language="sql",
+        )
+
+# Time per stage of this render and its warehouse cost, when turned on in the sidebar
+if show_timings:
+    debug.render_debug_panel(TRACE, CONN)
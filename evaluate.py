@@ -0,0 +1,68 @@
+"""Headless bulk evaluation of SQI result sets
+
+Searches the lowest SQI queries of one experience, or of every experience in sqi_business_experience.csv, and
+streams the normalized result sets to JSONL or Parquet. Interrupted runs resume from the checkpoint file.
+
+    python evaluate.py --business "Finish Line" --experience Finish-Line-Answers-Experience --output results.jsonl
+    python evaluate.py --all --lowest 100 --workers 8 --rate 10 --output results.parquet
+"""
+import argparse
+
+from utils import catalog, clients, evaluation, snowflake
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--experience", help="Experience key to evaluate, requires --business")
+    target.add_argument("--all", action="store_true", help="Evaluate every experience in the businesses file")
+    parser.add_argument("--business", help="Business name of the experience")
+    parser.add_argument("--businesses-file", default=catalog.FILEPATH, help="CSV of businesses and experiences")
+    parser.add_argument("--lookback", type=int, default=14, help="Lookback period in days, maximum 30")
+    parser.add_argument("--lowest", type=int, default=50, help="Number of lowest SQI queries to search")
+    parser.add_argument("--percentile", type=float, help="Optional min. searches threshold, as a percentile")
+    parser.add_argument("--workers", type=int, default=4, help="Number of searches run at the same time")
+    parser.add_argument("--rate", type=float, default=5.0, help="Maximum searches per second")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per search before giving up")
+    parser.add_argument("--output", default="results.jsonl", help="Output path, .jsonl or .parquet")
+    parser.add_argument("--checkpoint", help="Checkpoint path, defaults to the output path + .checkpoint")
+    args = parser.parse_args()
+    if args.experience and not args.business:
+        parser.error("--experience requires --business")
+    return args
+
+
+def main():
+    args = parse_args()
+    snowflake.configure_logging()
+    businesses = catalog.BusinessCatalog.from_csv(args.businesses_file)
+    if args.all:
+        experiences = businesses.frame[["business_name", "business_id", "experience_key"]].itertuples(index=False)
+    else:
+        experiences = [(args.business, businesses.business_id(args.business), args.experience)]
+
+    conn = snowflake.connect_to_snowflake()
+    writer = evaluation.ResultWriter(args.output)
+    checkpoint = evaluation.Checkpoint(args.checkpoint or args.output + ".checkpoint")
+    try:
+        evaluation.evaluate_experiences(
+            experiences,
+            conn,
+            writer,
+            checkpoint,
+            clients.get_client,
+            lookback=args.lookback,
+            lowest=args.lowest,
+            percentile=args.percentile,
+            workers=args.workers,
+            rate=args.rate,
+            retries=args.retries,
+        )
+    finally:
+        writer.close()
+        checkpoint.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
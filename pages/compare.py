@@ -0,0 +1,93 @@
+import streamlit as st
+from utils import catalog, debug, loading, sidebar, snowflake, telemetry
+
+st.set_page_config(page_title="Compare Experiences", page_icon="gear")
+st.title("In-Platform SQI")
+# Time every stage of this render, for the debug panel and the logs
+TRACE = telemetry.start_trace("compare")
+
+st.markdown(
+    """
+    Compare search quality across several experiences, or every experience with an SQI score, fetched in a few grouped Snowflake queries.
+    """
+)
+# Snowflake connection shared by every session, only opened once the first query needs it
+CONN = snowflake.get_connection()
+
+# Initialize user inputs in a sidebar
+# Keep the lookback and business selected on the other pages
+for key in ["lookback", "business_name"]:
+    if key in st.session_state:
+        st.session_state[key] = st.session_state[key]
+st.session_state.setdefault("lookback", sidebar.DEFAULTS["lookback"])
+businesses = catalog.get_catalog(CONN)
+with st.sidebar:
+    # Number input for lookback period, maximum 30 days
+    st.write("Select a lookback period")
+    lookback = st.number_input(
+        "Lookback Period (Days)",
+        min_value=0,
+        max_value=30,
+        step=1,
+        help="Maximum 30 days",
+        key="lookback",
+    )
+    st.write("Select businesses to compare")
+    all_businesses = st.checkbox("All businesses", help="Compare every experience with an SQI score.")
+    selected_businesses = st.multiselect(
+        "Business Names",
+        options=businesses.business_names,
+        default=[st.session_state["business_name"]] if "business_name" in st.session_state else [],
+        disabled=all_businesses,
+    )
+show_timings = debug.debug_toggle()
+if all_businesses:
+    selected_businesses = businesses.business_names
+pairs = tuple(
+    (business_name, experience_key)
+    for business_name in selected_businesses
+    for experience_key in businesses.experiences(business_name)
+)
+if not pairs:
+    st.write("Select at least one business to compare its experiences.")
+    st.stop()
+
+
+# Function to fetch query level SQI for every selected experience in a few grouped queries
+@st.experimental_memo()
+def compare_experiences(pairs, lookback, _conn):
+    return loading.query_level_sqi_many(pairs, lookback, _conn)
+
+
+frames, rollup = compare_experiences(pairs, lookback, CONN)
+if rollup.empty:
+    st.write("No data found for this lookback period. Please select a different period.")
+    st.stop()
+
+st.header("Experience Comparison")
+# Hero numbers across every selected experience
+col1, col2, col3 = st.columns(3)
+col1.metric("Experiences", value=len(rollup.index))
+col2.metric("Total searches", value=int(rollup["total_searches"].sum()))
+col3.metric(
+    "Search-weighted SQI",
+    value=round((rollup["search_weighted_sqi"] * rollup["total_searches"]).sum() / rollup["total_searches"].sum(), 2),
+    help="Average SQI across every selected experience, weighted by the searches of each query.",
+)
+# Average SQI of each experience, lowest first
+rollup = rollup.sort_values(by=["avg_experience_sqi"])
+st.bar_chart(rollup.set_index("experience_key")["avg_experience_sqi"])
+st.dataframe(rollup, use_container_width=True)
+
+# Drill down into the queries of one experience
+st.header("Queries by Experience")
+pair = st.selectbox(
+    "Select an experience:",
+    options=list(zip(rollup["business_name"], rollup["experience_key"])),
+    format_func=lambda pair: f"{pair[0]} / {pair[1]}",
+)
+st.dataframe(frames[pair], use_container_width=True)
+
+# Time per stage of this render and its warehouse cost, when turned on in the sidebar
+if show_timings:
+    debug.render_debug_panel(TRACE, CONN)
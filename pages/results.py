@@ -1,166 +1,106 @@
 import streamlit as st
-from yext import YextClient
-from utils import loading, snowflake, processing
+from utils import cards, clients, datasets, debug, loading, paging, processing, responses, sidebar, snowflake, telemetry
 
 st.set_page_config(page_title="View Search Results", page_icon="gear")
 st.title("In-Platform SQI")
+# Time every stage of this render, for the debug panel and the logs
+TRACE = telemetry.start_trace("results")
 
-FILEPATH = "/Users/cxi/datascience/new-sqi-prototype/sqi_business_experience.csv"
+# Maximum time in seconds for any single Snowflake query of a page render
+QUERY_TIMEOUT = 120
 
 st.markdown(
     """
     This app allows lets you pull search quality data from Snowflake by specifying filters such as business name, experience key and lookback period - without having to write a single SQL query.
     """
 )
-# Initialize user inputs in a sidebar
-with st.sidebar:
-    # Number input for lookback period, maximum 30 days
-    st.write("Select a lookback period")
-    lookback = st.sidebar.number_input(
-        "Lookback Period (Days)",
-        min_value=0,
-        max_value=30,
-        value=14,
-        step=1,
-        help="Maximum 30 days",
-    )
-    st.sidebar.write("Select a business and experience")
-    # Load all options for business selection from a .csv file containing all businesses and experiences with an SQI score in October 2022
-    businesses = loading.initialize_businesses(FILEPATH)
-    unique_businesses = businesses.business_name.unique()
-    # Business user input
-    business_name = st.sidebar.selectbox("Business Name", options=unique_businesses)
-    # Fetch the business ID, used to grab the API key for connecting with the Yext Client
-    user_business_id = loading.filter_businessid(businesses, business_name)
-    # Load all experiences for a particular business from a .csv file containing all businesses and experiences with an SQI score in October 2022, given the business name the user inputted above
-    experiences = loading.filter_experiences(businesses, business_name)
-    unique_experiences = experiences.experience_key.unique()
-    # User input for experience
-    experience_key = st.sidebar.selectbox("Experience Key", options=experiences["experience_key"])
-    # Allow user to select the minimum searches threshold for the table, using percentiles. This is to filter out long-tail queries. Defaults to 0.99
-    st.sidebar.write("Select a search threshold")
-    searches_percentile = st.slider(
-        "Min. Searches Threshold",
-        min_value=0.0,
-        max_value=1.0,
-        value=0.99,
-        step=0.01,
-        help="Select a minimum search volume threshold, represented by percentile of total searches, for queries to view SQI for.",
-    )
-
-# Connect to Snowflake
-@st.experimental_singleton()
-def connect_to_snowflake():
-    return snowflake.connect_to_snowflake()
-
-
-CONN = connect_to_snowflake()
-
-# Load table containing all queries and SQI scores
-query_level_sqi = loading.query_level_sqi(business_name, experience_key, lookback, CONN)
-# Query the dataframe so that we have a list of searches
-# Drop unneccessary columns
-display_df = query_level_sqi.drop(
-    columns=["business_name", "business_id", "experience_key", "avg_experience_sqi"]
-)
-display_df = display_df.reset_index(drop=True)
-# Establish a minimum searches threshold, based on the user inputted percentile and the search volume of the experience
-min_searches = int(
-    round(processing.searches_floor(display_df, "total_searches", searches_percentile), 0)
-)
-# filter out any queries that do not meet the minimum searches threshold
-display_df = display_df[display_df["total_searches"] >= min_searches]
-# Sort the table based on the sort order selected by the user
-display_df = processing.sort_df(display_df, sort_index="By SQI (Ascending)")
+# Snowflake connection shared by every session, only opened once the first query needs it
+CONN = snowflake.get_connection()
+
+# Initialize user inputs in a sidebar, shared with the other pages
+selection = sidebar.render_sidebar(CONN, show_sort_order=False)
+business_name = selection.business_name
+user_business_id = selection.business_id
+experience_key = selection.experience_key
+lookback = selection.lookback
+searches_percentile = selection.searches_percentile
+show_timings = debug.debug_toggle()
+
+
+# Load the table containing all queries and SQI scores, and the API key to connect to the YextClient, at the same time
+# API keys of every business are loaded together the first time, so switching businesses doesn't query Snowflake
+# The table is shared with the other pages, so it's only loaded if no page has loaded it this session
+# Queries still running from a previous render with different inputs are cancelled
+key = datasets.dataset_key(business_name, experience_key, lookback)
+dataset = datasets.get_dataset(st.session_state, key)
+calls = {"api_key": (clients.api_key, user_business_id, CONN)}
+if dataset is None:
+    calls["query_level_sqi"] = (loading.query_level_sqi, business_name, experience_key, lookback, CONN)
+scope = snowflake.query_scope(st.session_state, key, QUERY_TIMEOUT)
+try:
+    results = snowflake.run_concurrently(calls, scope)
+except snowflake.QueryCancelled as error:
+    st.warning(f"Loading SQI data was stopped: {error}")
+    st.stop()
+if dataset is None:
+    dataset = datasets.put_dataset(st.session_state, key, results["query_level_sqi"])
+api_key = results["api_key"]
+# Queries above the minimum searches threshold, sorted by SQI ascending
+display_df = dataset.view(searches_percentile, "By SQI (Ascending)")
 
 
 st.header("View Search Results")
 
-# Function to fetch the API key to connect to the YextClient
-@st.experimental_memo()
-def get_api_key(business_id, _conn):
-    query = """
-            select api_key
-            from prod_product.public.search_api_keys
-            where business_id = {}
-            limit 1
-        """.format(
-        business_id
-    )
-    key = snowflake.get_data_from_snowflake(query, _conn)
-    # Check to see if the API key exists
-    if len(key.index) == 0:
-        raise ValueError("No API Key found for selected business.")
-    api_key = key["api_key"][0]
-    return api_key
-
+# Answers API client for the business, shared between sessions and reusing open connections
+client = clients.get_client(api_key)
+# Searchable selectbox for the user to select a query, loading queries incrementally
+query_select, query_options = paging.query_picker(dataset, searches_percentile, "By SQI (Ascending)")
+if query_select is None:
+    st.write("No queries found. Please select a different period, threshold or search.")
+    st.stop()
+# Fetch the raw response object for the query, from the response cache if it was fetched recently
+raw_response = responses.cached_raw_response(client, api_key, query_select, experience_key)
+# Fetch the responses for the neighbouring queries in the background, so stepping through the selectbox is instant
+responses.prefetch_neighbours(client, api_key, query_options, query_select, experience_key)
+# Clean the response, remove unecessary parameters
+response = processing.cleaned_response(raw_response)
 
-# Fetch the API key to connect to the YextClient
-api_key = get_api_key(user_business_id, CONN)
 
-# Function to connect to the YextClient
+# Normalize the response once, reused across reruns for the same search
 @st.experimental_memo()
-def yextclient(api_key):
-    return YextClient(api_key)
+def normalized_response(query_id, query, experience_key, _response):
+    return processing.normalize_response(_response)
 
 
-# Connect to the YextClient
-client = yextclient(api_key)
-# Selectbox for the user to select a query
-query_select = st.selectbox("Select a query:", options=display_df["query"])
-# Fetch the raw response object from the YextClient for the query
-raw_response = processing.return_raw_response(client, query_select, experience_key)
-# Clean the response, remove unecessary parameters
-response = processing.cleaned_response(raw_response)
-# Initialize empty list of field params, for the user to select as display fields
-fields_list = []
-# Iterate through each vertical in the response
-for item in response:
-    # Iterate through each param of the vertical response
-    for key in item:
-        # Check to see if the param contains the vertical title
-        if key == "verticalConfigId":
-            vertical = item.get(key).title()
-        # Check to see if the param contains the vertical results object
-        if key == "results":
-            # Get result entities
-            result_list = item.get(key)
-            # If the vertical is a Knowledge Graph vertical, append all fields from the vertical's entities to the list of display fields
-            if vertical != "Links":
-                fields_list.append(processing.get_all_fields(result_list))
-            # If it's a third-party links vertical create a list and append all the fields to that list
-            else:
-                link_list = processing.get_link_fields(result_list)
+normalized = normalized_response(raw_response.get("query_id"), query_select, experience_key, response)
 # Check to see if there were no display fields, in that case there were no KG results
-if fields_list == []:
+if not normalized.fields:
     st.subheader("No Knowledge Graph results found for this query.")
-# flatten the list of all display fields for all verticals in a result set
-flat_list = [item for sublist in fields_list for item in sublist]
-# Only get the unique fields in the flattened list to display
-unique_list = processing.unique_fields(flat_list)
 # Initialize sidebar select option for display fields to display on KG entity profiles
 st.sidebar.write("Select entity fields to display on KG result profiles")
-try:
+if normalized.fields:
     display_fields = st.sidebar.multiselect(
         "Display Fields",
-        unique_list,
-        default=["name"] if "name" in unique_list else [],
+        normalized.fields,
+        default=["name"] if "name" in normalized.fields else [],
     )
-except NameError:
+else:
+    display_fields = []
     st.sidebar.text_input(
         "Display Fields",
-        label="No Knowledge Graph results were found for this query.",
+        value="No Knowledge Graph results were found for this query.",
         disabled=True,
     )
 # Initialize sidebar select option for display fields to display on third-party links entity profiles
 st.sidebar.write("Select fields to display on Links result profiles")
-try:
+if normalized.link_fields:
     links_fields = st.sidebar.multiselect(
         "Links Fields",
-        link_list,
-        default=["htmlTitle"] if "htmlTitle" in link_list else [],
+        normalized.link_fields,
+        default=["htmlTitle"] if "htmlTitle" in normalized.link_fields else [],
     )
-except NameError:
+else:
+    links_fields = []
     st.sidebar.text_input(
         "Links Fields",
         value="No Third-Party Links results were found for this query",
@@ -201,32 +141,14 @@ except IndexError:
 
 # Display the result cards for the query
 # Iterate through each vertical in the response
-for item in response:
-    # Iterate through each param of the vertical response
-    for key in item:
-        # Check to see if the param contains the vertical title
-        if key == "verticalConfigId":
-            vertical = item.get(key).title()
-            st.subheader("Vertical: " + vertical)
-        # Check to see if the param contains the vertical results object
-        if key == "results":
-            # Iterate through each entity in the vertical results
-            for object in item.get(key):
-                # Iterate through each field in the entity profile
-                for field in object:
-                    # Check if the Vertical is a links vertical
-                    if vertical == "Links":
-                        link = object
-                    else:
-                        # Get each field for non-links verticals
-                        if field == "data":
-                            result = object.get(field)
-                # Display Entity Profiles
-                if vertical == "Links":
-                    st.info(processing.get_card_display(link, links_fields))
-                else:
-                    st.info(processing.get_card_display(result, display_fields))
+# Each vertical's entity profiles are sent as one element, a batch of cards at a time
+for index, (vertical, profiles) in enumerate(normalized.modules):
+    cards.render_cards(normalized, index, links_fields if vertical == "Links" else display_fields, query_id)
 # Render full raw API response for the user to view
 st.header("View Full API Response")
 with st.expander("Click to view"):
     st.write(raw_response["raw_response"])
+
+# Time per stage of this render and its warehouse cost, when turned on in the sidebar
+if show_timings:
+    debug.render_debug_panel(TRACE, CONN)
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from utils import cache, schema
+
+# Number of days of per-day partial aggregates held by each store. Matches the maximum lookback of the app
+WINDOW_DAYS = 30
+# Maximum number of stores held by a StoreRegistry. The least recently used store is dropped beyond it
+MAX_STORES = int(os.getenv("SQI_MAX_DAILY_STORES", "64"))
+
+# Columns of the query level SQI table, in the same order as loading.QUERY. The business and experience columns are
+# the same on every row, so they are kept in the frame's attrs instead
+QUERY_LEVEL_COLUMNS = [
+    "query",
+    "query_sqi_score",
+    "avg_experience_sqi",
+    "total_searches",
+    "performance",
+]
+
+
+class DailyAggregateStore:
+    """
+    Holds per-day partial aggregates for the last WINDOW_DAYS days. The full window is fetched once, afterwards
+    only the days since the day before the last load are fetched again, once the day changes or the source tables
+    have had their daily refresh (see cache.last_refresh).
+    """
+
+    def __init__(self, fetch, window_days: int = WINDOW_DAYS):
+        # fetch(start, conn) returns a dataframe with a "day" column, containing every day >= start
+        self._fetch = fetch
+        self.window_days = window_days
+        self._frame = None
+        self._loaded_on = None
+        # Epoch time of the last fetch, compared against the daily refresh of the source tables
+        self._loaded_at = None
+        # Values that are the same on every row, kept from the attrs of each fetched frame
+        self.constants = {}
+        self._lock = threading.Lock()
+
+    # The frame held by the store, without fetching anything. None until the first fetch
+    @property
+    def loaded(self):
+        return self._frame
+
+    def frame(self, conn, today: date = None) -> pd.DataFrame:
+        today = today or date.today()
+        with self._lock:
+            if self._frame is None:
+                self._frame = self._fetch_days(today - timedelta(days=self.window_days), conn)
+            elif self._loaded_on < today or self._loaded_at < cache.last_refresh():
+                # The last loaded day may have been partial, and the refresh can still fill in late searches of the
+                # day before, so both are fetched again along with every day after them
+                start = self._loaded_on - timedelta(days=1)
+                new_days = self._fetch_days(start, conn)
+                old_days = self._frame[self._frame["day"] < pd.Timestamp(start)]
+                self._frame = pd.concat([old_days, new_days], ignore_index=True)
+            else:
+                return self._frame
+            # Drop any days that have fallen out of the window
+            start = pd.Timestamp(today - timedelta(days=self.window_days))
+            self._frame = self._frame[self._frame["day"] >= start].reset_index(drop=True)
+            self._frame.attrs = dict(self.constants)
+            self._loaded_on = today
+            self._loaded_at = time.time()
+            return self._frame
+
+    # Drop the held frame, so the next call to frame fetches the full window again
+    def clear(self):
+        with self._lock:
+            self._frame = None
+            self._loaded_on = None
+            self._loaded_at = None
+
+    def _fetch_days(self, start: date, conn) -> pd.DataFrame:
+        df = self._fetch(start, conn)
+        # An empty fetch has None for every constant, which mustn't replace the values of earlier fetches
+        self.constants.update({name: value for name, value in df.attrs.items() if value is not None})
+        # Make sure the day column can be compared against timestamps
+        df["day"] = pd.to_datetime(df["day"])
+        return df
+
+
+class StoreRegistry:
+    """
+    Thread-safe mapping of keys to DailyAggregateStore objects, shared between sessions. Holds at most `max_stores`
+    stores, dropping the least recently used one beyond that.
+    """
+
+    def __init__(self, max_stores: int = MAX_STORES):
+        self.max_stores = max_stores
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch) -> DailyAggregateStore:
+        with self._lock:
+            if key not in self._stores:
+                self._stores[key] = DailyAggregateStore(fetch)
+            self._stores.move_to_end(key)
+            while len(self._stores) > self.max_stores:
+                self._stores.popitem(last=False)
+            return self._stores[key]
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
+
+    # The store for a key if one has been created, without creating it
+    def peek(self, key):
+        with self._lock:
+            return self._stores.get(key)
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._stores.items())
+
+
+# Roll the per-day partial aggregates up into the query level SQI table for a given lookback period
+def rollup_query_sqi(daily: pd.DataFrame, lookback: int, today: date = None) -> pd.DataFrame:
+    today = today or date.today()
+    window = daily[daily["day"] >= pd.Timestamp(today - timedelta(days=lookback))]
+    if window.empty:
+        df = pd.DataFrame(columns=QUERY_LEVEL_COLUMNS).astype(
+            {"query_sqi_score": "float64", "avg_experience_sqi": "float64", "total_searches": "int64"}
+        )
+        df.attrs = dict(daily.attrs)
+        return df
+    df = (
+        window.groupby("query", sort=False, dropna=False)[["sqi_sum", "sqi_count", "total_searches"]]
+        .sum()
+        .reset_index()
+    )
+    # Average SQI per query, and the average of those averages across the experience
+    df["query_sqi_score"] = df["sqi_sum"] / df["sqi_count"].replace(0, np.nan)
+    df["avg_experience_sqi"] = df["query_sqi_score"].mean()
+    # Label each query relative to the experience average, using the same rounding as loading.QUERY
+    query_sqi = schema.round_half_away(df["query_sqi_score"], 2)
+    experience_sqi = schema.round_half_away(df["avg_experience_sqi"], 2)
+    df["performance"] = np.select(
+        [query_sqi < experience_sqi, query_sqi == experience_sqi],
+        ["Below Average", "Average"],
+        default="Above Average",
+    )
+    df = df.sort_values(by=["total_searches"], ascending=False, kind="stable")
+    df = df[QUERY_LEVEL_COLUMNS].reset_index(drop=True)
+    df.attrs = dict(daily.attrs)
+    return df
+
+
+# Roll the per-day partial aggregates of every experience up into the global SQI for a given lookback period
+def rollup_global_sqi(daily: pd.DataFrame, lookback: int, today: date = None) -> pd.DataFrame:
+    today = today or date.today()
+    window = daily[daily["day"] >= pd.Timestamp(today - timedelta(days=lookback))]
+    count = window["sqi_count"].sum()
+    score = window["sqi_sum"].sum() / count if count else np.nan
+    return pd.DataFrame({"query_sqi_score": [score]})
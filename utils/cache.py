@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+# Where cached frames are stored, shared between every process on the machine
+CACHE_DIR = os.getenv("SQI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sqi-prototype"))
+# Maximum size of all cached frames before the least recently used ones are evicted
+CACHE_MAX_BYTES = int(os.getenv("SQI_CACHE_MAX_MB", "1024")) * 1024 * 1024
+# Hour of the day (UTC) by which agg_sqi_v2_results has been refreshed. Entries cached before it expire
+REFRESH_HOUR_UTC = int(os.getenv("SQI_CACHE_REFRESH_HOUR", "10"))
+
+
+# Most recent refresh of agg_sqi_v2_results, as a unix timestamp
+def last_refresh(now: Optional[datetime] = None) -> float:
+    now = now or datetime.now(timezone.utc)
+    refresh = now.replace(hour=REFRESH_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if refresh > now:
+        refresh -= timedelta(days=1)
+    return refresh.timestamp()
+
+
+# Cache key for a query and its bind parameters. Whitespace in the query is normalized so formatting doesn't matter
+def cache_key(query: str, params: Optional[dict] = None) -> str:
+    normalized = " ".join(query.split())
+    payload = json.dumps([normalized, params or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Disk-backed cache of query results. Frames are stored as Parquet files and indexed in a SQLite database, so the
+    cache is shared between processes and survives restarts. Entries expire at the daily refresh of the SQI tables,
+    and the least recently used entries are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                "create table if not exists entries "
+                "(key text primary key, size integer, created real, accessed real)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.directory, "index.db"), timeout=30)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".parquet")
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        with self._connect() as db:
+            row = db.execute("select created from entries where key = ?", (key,)).fetchone()
+            if row is not None and row[0] < last_refresh():
+                self._delete(db, key)
+                row = None
+            if row is None or not os.path.exists(self._path(key)):
+                with self._lock:
+                    self.misses += 1
+                return None
+            db.execute("update entries set accessed = ? where key = ?", (time.time(), key))
+        try:
+            df = pd.read_parquet(self._path(key))
+        except FileNotFoundError:
+            # Evicted by another process since the index was checked
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        # Write to a temporary file of its own first, so readers never see a partially written frame and sessions
+        # writing the same key at the same time don't write into each other's file
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=key + ".", suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "insert or replace into entries values (?, ?, ?, ?)",
+                (key, os.path.getsize(path), now, now),
+            )
+            self._evict(db)
+
+    def _delete(self, db, key: str):
+        db.execute("delete from entries where key = ?", (key,))
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # Remove the least recently used entries until the cache fits in max_bytes
+    def _evict(self, db):
+        total = db.execute("select coalesce(sum(size), 0) from entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute("select key, size from entries order by accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._delete(db, key)
+            total -= size
+            LOGGER.info("Evicted cached result %s", key)
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            entries, size = db.execute("select count(*), coalesce(sum(size), 0) from entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+# Process-wide result cache, created on first use
+def get_cache() -> ResultCache:
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ResultCache()
+        return _CACHE
@@ -0,0 +1,45 @@
+import html
+
+import streamlit as st
+from utils import telemetry
+
+# Number of cards drawn per vertical at first, and added by each "Show more" click
+CARDS_PER_BATCH = 10
+# Cards are drawn inside a scrolling box of at most this height, so long verticals don't stretch the page
+MAX_HEIGHT = "40rem"
+# Same look as st.info
+CARD_STYLE = (
+    "padding: 1rem; margin-bottom: 0.75rem; border-radius: 0.5rem; "
+    "background-color: rgba(28, 131, 225, 0.1); color: rgb(0, 66, 128);"
+)
+
+
+# One markdown document with every card in a scrolling box. Blank lines around the card text keep it rendered as
+# markdown inside the HTML, and the text is escaped so entity fields can't inject HTML
+def cards_markdown(cards: list) -> str:
+    parts = [f'<div style="max-height: {MAX_HEIGHT}; overflow-y: auto;">\n\n']
+    for card in cards:
+        parts.append(f'<div style="{CARD_STYLE}">\n\n{html.escape(card, quote=False)}\n\n</div>\n\n')
+    parts.append("</div>")
+    return "".join(parts)
+
+
+def render_cards(normalized, index: int, fields: list, query_id, key="cards"):
+    """
+    Renders the cards of one vertical of a normalized response as a single markdown element, CARDS_PER_BATCH cards
+    at a time with a button to show more, instead of an element per card.
+    """
+    vertical, profiles = normalized.modules[index]
+    limit_key = f"{key}_{index}_limit"
+    # Start from the first batch again whenever the query changes
+    if st.session_state.get(f"{limit_key}_for") != query_id:
+        st.session_state[limit_key] = CARDS_PER_BATCH
+        st.session_state[f"{limit_key}_for"] = query_id
+    limit = st.session_state[limit_key]
+    with telemetry.span("cards.render_cards", vertical=vertical, cards=min(limit, len(profiles))):
+        markdown = f"### Vertical: {vertical}\n\n" + cards_markdown(normalized.cards(index, fields, limit=limit))
+        st.markdown(markdown, unsafe_allow_html=True)
+    if len(profiles) > limit:
+        if st.button(f"Show more {vertical} results ({len(profiles) - limit} more)", key=f"{limit_key}_more"):
+            st.session_state[limit_key] = limit + CARDS_PER_BATCH
+            st.experimental_rerun()
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+from utils import snowflake
+
+LOGGER = logging.getLogger(__name__)
+
+# Businesses and experiences with an SQI score in October 2022, used until the catalog is refreshed from Snowflake
+FILEPATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sqi_business_experience.csv")
+# How often the catalog is refreshed from Snowflake, in seconds. 0 turns refreshing off
+REFRESH_SECONDS = int(os.getenv("SQI_CATALOG_REFRESH_SECONDS", str(24 * 60 * 60)))
+
+# Every business and experience with an SQI score in the current or previous month
+CATALOG_QUERY = """
+    select distinct
+        yext_accounts.business_name,
+        agg_sqi_v2_by_experience.business_id,
+        agg_sqi_v2_by_experience.experience_key
+    from prod_data_science.public.agg_sqi_v2_by_experience
+    join prod_product.public.yext_accounts using (business_id)
+    where date_from_parts(agg_sqi_v2_by_experience.year, agg_sqi_v2_by_experience.month, 1)
+        >= dateadd('month', -1, date_trunc('month', current_date()))
+    order by 1, 3
+    """
+
+
+class BusinessCatalog:
+    """
+    Businesses and their experiences, indexed by business name so lookups don't scan the frame.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        df = df.rename(str.lower, axis="columns")
+        self.frame = df
+        self.loaded_at = time.time()
+        self.business_ids = {}
+        self.experience_keys = {}
+        for business_name, business_id, experience_key in df[
+            ["business_name", "business_id", "experience_key"]
+        ].itertuples(index=False):
+            self.business_ids.setdefault(business_name, business_id)
+            self.experience_keys.setdefault(business_name, []).append(experience_key)
+        self.business_names = list(self.business_ids)
+
+    @classmethod
+    def from_csv(cls, filepath: str = FILEPATH):
+        return cls(pd.read_csv(filepath))
+
+    @classmethod
+    def from_snowflake(cls, conn):
+        return cls(snowflake.get_data_from_snowflake(CATALOG_QUERY, conn))
+
+    def business_id(self, business_name: str):
+        return self.business_ids[business_name]
+
+    def experiences(self, business_name: str) -> list:
+        return self.experience_keys.get(business_name, [])
+
+    def __len__(self):
+        return len(self.frame.index)
+
+
+_CATALOG = None
+_REFRESHING = False
+_LOCK = threading.Lock()
+
+
+def _refresh(conn):
+    global _CATALOG, _REFRESHING
+    try:
+        catalog = BusinessCatalog.from_snowflake(conn)
+        if not len(catalog):
+            raise ValueError("No businesses found")
+        with _LOCK:
+            _CATALOG = catalog
+        LOGGER.info("Refreshed business catalog with %s experiences", len(catalog))
+    except Exception:
+        LOGGER.exception("Refreshing the business catalog failed, keeping the current one")
+        # Wait a full refresh interval before trying again
+        with _LOCK:
+            _CATALOG.loaded_at = time.time()
+    finally:
+        with _LOCK:
+            _REFRESHING = False
+
+
+def get_catalog(conn=None, refresh_seconds: int = REFRESH_SECONDS) -> BusinessCatalog:
+    """
+    Returns the process-wide business catalog. It is loaded from the businesses file once, and refreshed from
+    Snowflake in the background every `refresh_seconds` when a connection is given.
+    """
+    global _CATALOG, _REFRESHING
+    with _LOCK:
+        if _CATALOG is None:
+            _CATALOG = BusinessCatalog.from_csv()
+            # Start the first refresh straight away
+            _CATALOG.loaded_at = 0
+        stale = refresh_seconds and time.time() - _CATALOG.loaded_at > refresh_seconds
+        if conn is not None and stale and not _REFRESHING:
+            _REFRESHING = True
+            threading.Thread(target=_refresh, args=(conn,), daemon=True).start()
+        return _CATALOG
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+
+from utils import catalog, loading
+
+LOGGER = logging.getLogger(__name__)
+
+# Connections kept open to the Answers API, shared by every client. Should cover the evaluation workers
+POOL_MAXSIZE = int(os.getenv("SQI_YEXT_POOL_SIZE", "16"))
+# Seconds to wait for the Answers API to connect and to respond
+REQUEST_TIMEOUT = (5, 30)
+# Retries of a search that failed to connect or got a 502, 503 or 504 back
+REQUEST_RETRIES = 2
+# How long a business found to have no API key is remembered, before the keys are loaded again to look for it
+MISSING_KEY_SECONDS = catalog.REFRESH_SECONDS
+
+
+class PooledYextClient:
+    """
+    Answers API client for one API key, making the same universal search request as YextClient over a shared
+    keep-alive session, so searches reuse open connections instead of a new TLS handshake each.
+    """
+
+    def __init__(self, api_key: str, session, v: str = "20200101", env: str = "PRODUCTION"):
+        self.api_key = api_key
+        self.session = session
+        self.v = v
+        self.env = env
+
+    def __repr__(self):
+        return "Pooled Yext API client"
+
+    def search_answers_universal(self, query, experience_key, locale="en", version="PRODUCTION", headers=None):
+        # Imported on the first search, so pages don't load the Yext library before they need it
+        from yext import YextClient
+        from yext.answers_universal_results import AnswersUniversalResults
+
+        params = {
+            "input": query,
+            "api_key": self.api_key,
+            "locale": locale,
+            "v": self.v,
+            "experienceKey": experience_key,
+            "version": version,
+        }
+        endpoint = YextClient.ANSWERS_ENDPOINTS[self.env]["answers_universal"]
+        response = self.session.get(endpoint, params=params, headers=headers or {}, timeout=REQUEST_TIMEOUT)
+        return AnswersUniversalResults(response)
+
+
+_SESSION = None
+_CLIENTS = {}
+_API_KEYS = None
+# Time each business without an API key was last looked for
+_MISSING_KEYS = {}
+_LOCK = threading.Lock()
+
+
+def _new_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # The last failed response is returned rather than raised, so it is reported like any other failed search
+    retries = Retry(
+        total=REQUEST_RETRIES, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=POOL_MAXSIZE, max_retries=retries))
+    return session
+
+
+# Process-wide Answers API client for an API key, created on first use and shared by every session
+def get_client(api_key: str) -> PooledYextClient:
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = _new_session()
+        if api_key not in _CLIENTS:
+            _CLIENTS[api_key] = PooledYextClient(api_key, _SESSION)
+        return _CLIENTS[api_key]
+
+
+def api_key(business_id, conn) -> str:
+    """
+    Returns the API key of a business from a process-wide map of every business's key, loaded in a single query the
+    first time any key is needed. The map is reloaded for a business missing from it, in case its key was added
+    since, at most once per MISSING_KEY_SECONDS for each business. Raises ValueError when the business has no API key.
+    """
+    global _API_KEYS
+    business_id = int(business_id)
+    with _LOCK:
+        api_keys = _API_KEYS
+        missing_since = _MISSING_KEYS.get(business_id)
+    recently_missing = missing_since is not None and time.time() - missing_since < MISSING_KEY_SECONDS
+    if api_keys is None or (business_id not in api_keys and not recently_missing):
+        api_keys = loading.get_api_keys(conn)
+        LOGGER.info("Loaded API keys of %s businesses", len(api_keys))
+        with _LOCK:
+            _API_KEYS = api_keys
+            if business_id in api_keys:
+                _MISSING_KEYS.pop(business_id, None)
+            else:
+                _MISSING_KEYS[business_id] = time.time()
+    if business_id not in api_keys:
+        raise ValueError("No API Key found for selected business.")
+    return api_keys[business_id]
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from utils import telemetry
+
+# Character shingle length
+SHINGLE = 3
+# MinHash signature length, split into BANDS bands of NUM_PERM // BANDS rows for LSH
+NUM_PERM = 64
+BANDS = 16
+# Minimum estimated Jaccard similarity of a query to the center of its cluster
+THRESHOLD = 0.7
+
+
+# Character shingles of every query, as (query position, shingle) arrays sorted by query position
+# Each shingle is SHINGLE bytes packed into an integer, so no hashing is needed. Queries shorter than SHINGLE get a
+# single shingle of the whole query
+def shingles(queries) -> tuple:
+    encoded = [" ".join(str(query).lower().split()).encode("utf-8") for query in queries]
+    lengths = np.array([len(query) for query in encoded], dtype=np.int64)
+    buffer = np.frombuffer(b"".join(encoded) + b"\0" * SHINGLE, dtype=np.uint8).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) else lengths
+    counts = np.maximum(lengths - SHINGLE + 1, 1)
+    owners = np.repeat(np.arange(len(encoded)), counts)
+    starts = np.repeat(offsets, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    values = np.zeros(len(starts), dtype=np.int64)
+    for i in range(SHINGLE):
+        # Bytes past the end of a short query are masked out, so they don't leak in from the next query
+        byte = np.where(i < lengths[owners], buffer[starts + i], 0)
+        values = (values << 8) | byte
+    # Mark short queries with their length, so "a" and "a\0" style shingles never collide
+    short = lengths[owners] < SHINGLE
+    values[short] |= (lengths[owners][short] + 1) << (8 * SHINGLE)
+    return owners, values
+
+
+# MinHash signature of every query, shape (queries, NUM_PERM)
+# Uses multiply-shift hashing, ((a * x + b) mod 2^64) >> 32, which needs no modulo and wraps in uint64 arithmetic
+def minhash_signatures(owners, values, n, num_perm=NUM_PERM, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+    segment_starts = np.searchsorted(owners, np.arange(n))
+    values = values.astype(np.uint64)
+    shift = np.uint64(32)
+    signatures = np.empty((n, num_perm), dtype=np.uint32)
+    for i in range(num_perm):
+        hashed = ((a[i] * values + b[i]) >> shift).astype(np.uint32)
+        signatures[:, i] = np.minimum.reduceat(hashed, segment_starts)
+    return signatures
+
+
+# LSH bucket of every query in every band, shape (bands, queries), numbered from 0 within each band
+def band_buckets(signatures, bands=BANDS) -> np.ndarray:
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    multipliers = np.random.default_rng(1).integers(0, 1 << 63, size=rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    buckets = np.empty((bands, n), dtype=np.int64)
+    for band in range(bands):
+        # Combine the band's rows into one 64 bit bucket key
+        keys = signatures[:, band * rows : (band + 1) * rows].astype(np.uint64) @ multipliers
+        buckets[band] = np.unique(keys, return_inverse=True)[1].ravel()
+    return buckets
+
+
+def star_clusters(signatures, buckets, rank, threshold=THRESHOLD) -> np.ndarray:
+    """
+    Star clustering over the LSH buckets: the highest ranked query of a cluster is its center, and every other query
+    of the cluster agrees with the center's signature on at least `threshold` of positions. Unlike merging every
+    similar pair, chains of similar queries never join unrelated queries.
+    Each query is compared against the centers of the highest ranked query of each of its buckets, and joins the
+    highest ranked similar one or else becomes a center itself. Queries are settled in rounds, each round settling
+    every query whose bucket leaders are settled. Returns the center of every query.
+    """
+    bands, n = buckets.shape
+    # Highest ranked query of the bucket of every query, in every band
+    leaders = np.empty((bands, n), dtype=np.int64)
+    for band in range(bands):
+        order = np.lexsort((rank, buckets[band]))
+        sorted_buckets = buckets[band][order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        leaders[band][order] = np.repeat(order[starts], np.diff(np.r_[starts, n]))
+    positions = np.arange(n)
+    led = leaders == positions
+    labels = np.full(n, -1, dtype=np.int64)
+    while True:
+        unsettled = np.flatnonzero(labels < 0)
+        if len(unsettled) == 0:
+            return labels
+        # Leaders are ranked above the queries they lead, so the highest ranked unsettled query is always ready
+        ready = unsettled[(led[:, unsettled] | (labels[leaders[:, unsettled]] >= 0)).all(axis=0)]
+        best = np.full(len(ready), -1, dtype=np.int64)
+        for band in range(bands):
+            candidates = labels[leaders[band][ready]]
+            similar = ~led[band][ready]
+            similar[similar] = (signatures[ready[similar]] == signatures[candidates[similar]]).mean(axis=1) >= threshold
+            better = similar & ((best < 0) | (rank[candidates] < rank[np.maximum(best, 0)]))
+            best[better] = candidates[better]
+        labels[ready] = np.where(best >= 0, best, ready)
+
+
+@telemetry.traced()
+def cluster_queries(queries, priority=None, num_perm=NUM_PERM, bands=BANDS, threshold=THRESHOLD) -> np.ndarray:
+    """
+    Groups near-duplicate queries with MinHash over character shingles, LSH banding and star clustering, each group
+    around its query with the highest `priority` (e.g. searches), or its first query without one.
+    Returns a cluster label per query, the position of the query at the center of its cluster.
+    """
+    n = len(queries)
+    if n == 0:
+        return np.array([], dtype=np.int64)
+    owners, values = shingles(queries)
+    signatures = minhash_signatures(owners, values, n, num_perm)
+    # Rank 0 is the highest priority, ties keep their order
+    order = np.argsort(-np.asarray(priority, dtype="float64"), kind="stable") if priority is not None else np.arange(n)
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    return star_clusters(signatures, band_buckets(signatures, bands), rank, threshold)
+
+
+def cluster_table(df: pd.DataFrame, labels: np.ndarray, sample: int = 5) -> pd.DataFrame:
+    """
+    Aggregates a query table by cluster: the cluster's most searched query, which is its center when clustered by
+    searches, number of queries, total searches, search-weighted SQI and a sample of its queries.
+    """
+    df = df.assign(
+        cluster=labels,
+        weighted_sqi=df["query_sqi_score"].astype("float64") * df["total_searches"],
+    )
+    # Most searched queries first, so the first query of each cluster is its representative
+    df = df.sort_values(by=["total_searches"], ascending=False, kind="stable")
+    grouped = df.groupby("cluster", sort=False)
+    clusters = grouped.agg(
+        query=("query", "first"),
+        queries=("query", "size"),
+        total_searches=("total_searches", "sum"),
+        weighted_sqi=("weighted_sqi", "sum"),
+    )
+    clusters["query_sqi_score"] = (clusters["weighted_sqi"] / clusters["total_searches"]).round(2)
+    first_members = df[grouped.cumcount() < sample]
+    clusters["members"] = first_members.groupby("cluster", sort=False)["query"].agg(", ".join)
+    return clusters[["query", "queries", "query_sqi_score", "total_searches", "members"]].reset_index(drop=True)
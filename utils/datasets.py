@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date
+
+import pandas as pd
+from utils import clustering, processing, schema, search
+
+# Number of datasets kept per session
+MAX_DATASETS = 8
+
+
+@dataclass
+class Dataset:
+    """
+    The query level SQI frame for one (business, experience, lookback, snapshot date), with its derived views.
+    Views are computed on first use and kept, so every page showing the same dataset shares them.
+    """
+
+    business: str
+    experience: str
+    lookback: int
+    snapshot_date: date
+    frame: pd.DataFrame
+    views: dict = field(default_factory=dict)
+
+    # Table shown to the user, without the columns that are the same on every row
+    @property
+    def display(self) -> pd.DataFrame:
+        if "display" not in self.views:
+            display_df = self.frame.drop(columns=schema.HOISTED_COLUMNS, errors="ignore")
+            self.views["display"] = display_df.reset_index(drop=True)
+        return self.views["display"]
+
+    # Average SQI for the experience, kept in the frame's attrs. Raises IndexError when there is no data for the lookback
+    @property
+    def experience_sqi(self):
+        if self.frame.empty:
+            raise IndexError("No data for this lookback")
+        return self.frame.attrs["avg_experience_sqi"]
+
+    # Index for instant threshold and sort changes, built once per dataset
+    @property
+    def index(self) -> processing.ViewIndex:
+        if "index" not in self.views:
+            self.views["index"] = processing.ViewIndex(self.display)
+        return self.views["index"]
+
+    # Search index over the query text, built once per dataset
+    @property
+    def search_index(self) -> search.QuerySearchIndex:
+        if "search_index" not in self.views:
+            self.views["search_index"] = search.QuerySearchIndex(self.display["query"])
+        return self.views["search_index"]
+
+    # Near-duplicate queries grouped into clusters, with their total searches and search-weighted SQI
+    @property
+    def clusters(self) -> pd.DataFrame:
+        if "clusters" not in self.views:
+            labels = clustering.cluster_queries(self.display["query"], self.display["total_searches"])
+            self.views["clusters"] = clustering.cluster_table(self.display, labels)
+        return self.views["clusters"]
+
+    # Clusters whose combined searches are at or above the searches percentile of single queries, in the given
+    # sort order. Long-tail queries below the threshold on their own still count towards their cluster
+    def cluster_view(self, searches_percentile: float, sort_index: str) -> pd.DataFrame:
+        clusters = self.clusters
+        clusters = clusters[clusters["total_searches"] >= self.index.min_searches(searches_percentile)]
+        return processing.sort_df(clusters, sort_index).reset_index(drop=True)
+
+    # Positions of the queries at or above the searches percentile, in the given sort order, optionally only the
+    # queries matching a search term
+    def rows(self, searches_percentile: float, sort_index: str, term: str = "", mode: str = "Substring"):
+        rows = self.index.rows(searches_percentile, sort_index)
+        if term:
+            rows = search.filter_rows(rows, self.search_index.search(term, mode), len(self.display.index))
+        return rows
+
+    # Queries at or above the searches percentile, in the given sort order
+    def view(self, searches_percentile: float, sort_index: str) -> pd.DataFrame:
+        return self.display.iloc[self.rows(searches_percentile, sort_index)]
+
+
+def dataset_key(business, experience, lookback, snapshot_date=None) -> tuple:
+    return (business, experience, int(lookback), snapshot_date or date.today())
+
+
+# Return the session's dataset for a key, or None if it hasn't been loaded yet
+def get_dataset(state, key):
+    datasets = state.setdefault("datasets", OrderedDict())
+    if key in datasets:
+        datasets.move_to_end(key)
+        return datasets[key]
+    return None
+
+
+# Store a loaded frame as the session's dataset for a key, dropping the least recently used datasets
+def put_dataset(state, key, frame) -> Dataset:
+    datasets = state.setdefault("datasets", OrderedDict())
+    datasets[key] = Dataset(*key, frame)
+    while len(datasets) > MAX_DATASETS:
+        datasets.popitem(last=False)
+    return datasets[key]
+
+
+# Memory used by each of the session's datasets
+def memory_report(state) -> pd.DataFrame:
+    rows = []
+    for (business, experience, lookback, snapshot_date), dataset in state.get("datasets", {}).items():
+        report = schema.memory_report(dataset.frame)
+        rows.append(
+            {
+                "business": business,
+                "experience": experience,
+                "lookback": lookback,
+                "rows": report["rows"],
+                "bytes": report["bytes"],
+            }
+        )
+    return pd.DataFrame(rows, columns=["business", "experience", "lookback", "rows", "bytes"])
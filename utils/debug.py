@@ -0,0 +1,67 @@
+import pandas as pd
+import streamlit as st
+from utils import cache, datasets, loading, responses, telemetry
+
+# Number of Snowflake query IDs kept per session for looking up warehouse statistics
+MAX_QUERY_IDS = 50
+
+
+# Time, rows and bytes per stage, summed over every span of the stage
+def stage_summary(spans: pd.DataFrame) -> pd.DataFrame:
+    for column in ["rows", "bytes"]:
+        if column not in spans.columns:
+            spans[column] = None
+    summary = spans.groupby("span", sort=False).agg(
+        calls=("span", "size"),
+        seconds=("seconds", "sum"),
+        max_seconds=("seconds", "max"),
+        rows=("rows", "sum"),
+        bytes=("bytes", "sum"),
+    )
+    return summary.sort_values(by=["seconds"], ascending=False).reset_index()
+
+
+# Sidebar checkbox turning the debug panel on, kept on when switching between pages
+def debug_toggle(key="show_timings") -> bool:
+    if key in st.session_state:
+        st.session_state[key] = st.session_state[key]
+    return st.sidebar.checkbox("Show timings", key=key, help="Time every stage of the page and its warehouse cost.")
+
+
+def render_debug_panel(trace: telemetry.Trace, conn, key="debug"):
+    """
+    Renders the spans of the page render so far: time per stage, every span with its Snowflake query ID, rows,
+    bytes and cache hit or miss, the memory held by the session's datasets and the daily aggregate stores, and on
+    request the warehouse statistics of the render's Snowflake queries.
+    Call it last, so it includes every stage of the render.
+    """
+    with st.expander("Timings and warehouse cost", expanded=True):
+        spans = trace.frame()
+        if spans.empty:
+            st.write("No stages were timed in this render.")
+            return
+        top_level = spans[spans["depth"] == 0]
+        st.caption(f"Trace {trace.trace_id}: {len(spans.index)} spans, {top_level['seconds'].sum():.2f}s timed")
+        st.dataframe(stage_summary(spans), use_container_width=True)
+        # Indent nested spans under their parent
+        spans["span"] = ["  " * depth + name for depth, name in zip(spans["depth"], spans["span"])]
+        columns = [
+            column
+            for column in ["span", "seconds", "cache", "rows", "bytes", "query_id", "thread", "error"]
+            if column in spans.columns
+        ]
+        st.dataframe(spans[columns], use_container_width=True)
+        col1, col2 = st.columns(2)
+        col1.write({"result cache": cache.get_cache().stats(), "response cache": responses.get_cache().stats()})
+        col2.caption("Datasets held by this session")
+        col2.dataframe(datasets.memory_report(st.session_state), use_container_width=True)
+        col2.caption("Daily aggregate stores, shared by every session")
+        col2.dataframe(loading.daily_store_memory_report(), use_container_width=True)
+        # Keep the query IDs of earlier renders, since clicking the button reruns the page and its queries may
+        # then be served from the cache
+        query_ids = st.session_state.setdefault(f"{key}_query_ids", [])
+        if "query_id" in spans.columns:
+            query_ids.extend(query_id for query_id in spans["query_id"].dropna() if query_id not in query_ids)
+            del query_ids[:-MAX_QUERY_IDS]
+        if query_ids and st.button("Load warehouse stats", key=f"{key}_warehouse"):
+            st.dataframe(loading.warehouse_stats(query_ids, conn), use_container_width=True)
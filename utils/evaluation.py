@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils import clients, loading, processing, schema, snowflake
+
+LOGGER = logging.getLogger(__name__)
+
+# Fields rendered on the result cards, matching the defaults of the results page
+DEFAULT_FIELDS = ["name"]
+DEFAULT_LINK_FIELDS = ["htmlTitle"]
+
+# Schema of the normalized result rows, one row per entity of each vertical in a query's result set
+RESULT_SCHEMA = pa.schema(
+    [
+        ("business_name", pa.string()),
+        ("business_id", pa.int64()),
+        ("experience_key", pa.string()),
+        ("query", pa.string()),
+        ("query_sqi_score", pa.float64()),
+        ("total_searches", pa.int64()),
+        ("performance", pa.string()),
+        ("query_id", pa.string()),
+        ("vertical", pa.string()),
+        ("rank", pa.int64()),
+        ("card", pa.string()),
+        ("profile", pa.string()),
+        ("error", pa.string()),
+    ]
+)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker, allowing at most `rate` calls per second on average.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """
+    Append-only record of the queries that have already been written, so an interrupted run can be resumed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a")
+
+    @staticmethod
+    def key(business_id, experience_key, query) -> str:
+        return json.dumps([str(business_id), experience_key, query])
+
+    def mark(self, key: str):
+        self._file.write(key + "\n")
+        self._file.flush()
+        self.done.add(key)
+
+    def close(self):
+        self._file.close()
+
+
+class ResultWriter:
+    """
+    Streams normalized result rows to a JSONL file, or to a Parquet file when the path ends in .parquet.
+    Parquet output is written to a new part file per run, so resumed runs never rewrite earlier parts.
+    """
+
+    def __init__(self, path: str):
+        self.parquet = path.endswith(".parquet")
+        if self.parquet:
+            os.makedirs(path, exist_ok=True)
+            part = os.path.join(path, "part-{}.parquet".format(time.strftime("%Y%m%d%H%M%S")))
+            self._writer = pq.ParquetWriter(part, RESULT_SCHEMA)
+        else:
+            self._file = open(path, "a")
+
+    def write(self, rows: list):
+        if self.parquet:
+            self._writer.write_table(pa.Table.from_pylist(rows, schema=RESULT_SCHEMA))
+        else:
+            for row in rows:
+                self._file.write(json.dumps(row, default=str) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self.parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+
+# Call fn, retrying with exponential backoff and jitter if it raises
+def with_retries(fn, *args, attempts: int = 3, backoff: float = 1.0):
+    for attempt in range(attempts):
+        try:
+            return fn(*args)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff * 2**attempt * (1 + random.random())
+            LOGGER.warning("Attempt %s failed, retrying in %.1fs", attempt + 1, delay)
+            time.sleep(delay)
+
+
+# Fetch the N lowest SQI queries of an experience, thresholded and sorted by Snowflake
+def lowest_sqi_queries(business, experience, lookback, limit, percentile, conn):
+    query, params = loading.build_query_level_sql(
+        business, experience, lookback, percentile, sort_index="By SQI (Ascending)", limit=limit
+    )
+    df = snowflake.get_data_from_snowflake(query, conn, params=params)
+    df["query_sqi_score"] = schema.round_half_away(df["query_sqi_score"], 2)
+    return df
+
+
+# Columns of a result row that describe the query itself
+def _query_columns(row):
+    return {
+        "business_name": row["business_name"],
+        "business_id": int(row["business_id"]),
+        "experience_key": row["experience_key"],
+        "query": row["query"],
+        "query_sqi_score": float(row["query_sqi_score"]),
+        "total_searches": int(row["total_searches"]),
+        "performance": row["performance"],
+    }
+
+
+# Search a query and normalize the result set into one row per entity of each vertical
+def evaluate_query(client, row, fields=DEFAULT_FIELDS, link_fields=DEFAULT_LINK_FIELDS):
+    base = _query_columns(row)
+    raw_response = processing.return_raw_response(client, row["query"], row["experience_key"])
+    base["query_id"] = raw_response.get("query_id")
+    rows = []
+    normalized = processing.normalize_response(processing.cleaned_response(raw_response))
+    for vertical, profiles in normalized.modules:
+        card_fields = link_fields if vertical == "Links" else fields
+        for rank, profile in enumerate(profiles):
+            rows.append(
+                dict(
+                    base,
+                    vertical=vertical,
+                    rank=rank,
+                    card=processing.get_card_display(profile, card_fields),
+                    profile=json.dumps(profile, default=str),
+                )
+            )
+    # Keep a row for queries without any results, so they show up in the audit too
+    return rows or [dict(base, vertical=None, rank=None, card=None, profile=None)]
+
+
+def evaluate_experiences(
+    experiences,
+    conn,
+    writer: ResultWriter,
+    checkpoint: Checkpoint,
+    client_factory,
+    lookback: int = 14,
+    lowest: int = 50,
+    percentile=None,
+    workers: int = 4,
+    rate: float = 5.0,
+    retries: int = 3,
+):
+    """
+    Runs the searches for the `lowest` SQI queries of each (business_name, business_id, experience_key) in
+    `experiences` over a pool of `workers` threads, limited to `rate` searches per second across the pool.
+    Results are written as they complete; queries already in the checkpoint are skipped.
+    """
+    limiter = RateLimiter(rate)
+
+    def search(client, row):
+        # Every attempt, including retries, waits for the rate limiter
+        def attempt():
+            limiter.acquire()
+            return evaluate_query(client, row)
+
+        return with_retries(attempt, attempts=retries)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for business_name, business_id, experience_key in experiences:
+            try:
+                client = client_factory(clients.api_key(business_id, conn))
+                queries = lowest_sqi_queries(business_name, experience_key, lookback, lowest, percentile, conn)
+            except Exception:
+                LOGGER.exception("Skipping %s / %s", business_name, experience_key)
+                continue
+            futures = {}
+            for row in queries.to_dict("records"):
+                key = checkpoint.key(business_id, experience_key, row["query"])
+                if key not in checkpoint.done:
+                    futures[pool.submit(search, client, row)] = (key, row)
+            for future in as_completed(futures):
+                key, row = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as error:
+                    # Record the failure and leave the query out of the checkpoint, so a resumed run retries it
+                    LOGGER.warning("Search for %r failed: %s", row["query"], error)
+                    writer.write([dict(_query_columns(row), error=str(error))])
+                    continue
+                writer.write(rows)
+                checkpoint.mark(key)
+            LOGGER.info("Evaluated %s queries for %s / %s", len(futures), business_name, experience_key)
@@ -1,10 +1,15 @@
+import logging
+import os
+from datetime import date, timedelta
+
 import pandas as pd
-import streamlit as st
-from utils import snowflake
+from utils import aggregates, schema, snowflake, telemetry
+
+LOGGER = logging.getLogger(__name__)
 
 QUERY = """
     select
-        distinct searches.tokenizer_normalized_query as query,
+        searches.tokenizer_normalized_query as query,
         yext_accounts.business_id,
         yext_accounts.business_name,
         searches.experience_key,
@@ -23,16 +28,18 @@ QUERY = """
         and searches.experience_key = agg_sqi_v2_by_experience.experience_key
         and year(searches.timestamp) = agg_sqi_v2_by_experience.year
         and month(searches.timestamp) = agg_sqi_v2_by_experience.month
-    where date(searches.timestamp) >= dateadd('day', -{}, current_date())
-    and yext_accounts.business_name = '{}'
-    and searches.experience_key = '{}'
+    where date(searches.timestamp) >= dateadd('day', -%(lookback)s, current_date())
+    and yext_accounts.business_name = %(business)s
+    and searches.experience_key = %(experience)s
     group by 1, 2, 3, 4
-    order by 7 desc
     """
 
-BUSINESS_QUERY = """
+# Per-day partial aggregates of SQI across every business and experience, used to answer any lookback locally
+GLOBAL_DAILY_QUERY = """
     select
-        avg(agg_sqi_v2_results.sqi) as query_sqi_score
+        date(searches.timestamp) as day,
+        sum(agg_sqi_v2_results.sqi) as sqi_sum,
+        count(agg_sqi_v2_results.sqi) as sqi_count
     from prod_data_science.public.agg_sqi_v2_results
     join prod_data_hub.answers.searches using(query_id)
     join prod_product.public.yext_accounts using (business_id)
@@ -41,54 +48,365 @@ BUSINESS_QUERY = """
         and searches.experience_key = agg_sqi_v2_by_experience.experience_key
         and year(searches.timestamp) = agg_sqi_v2_by_experience.year
         and month(searches.timestamp) = agg_sqi_v2_by_experience.month
-    where date(searches.timestamp) >= dateadd('day', -{}, current_date())
+    where date(searches.timestamp) >= %(start)s
+    group by 1
 """
-# Load available businesses + experiences
-def initialize_businesses(filepath):
-    business_df = pd.read_csv(filepath)
-    business_df = business_df.rename(str.lower, axis="columns")
-    return business_df
 
+# Per-day partial aggregates for every query of an experience, used to answer any lookback without re-querying
+DAILY_QUERY = """
+    select
+        date(searches.timestamp) as day,
+        searches.tokenizer_normalized_query as query,
+        yext_accounts.business_id,
+        yext_accounts.business_name,
+        searches.experience_key,
+        sum(agg_sqi_v2_results.sqi) as sqi_sum,
+        count(agg_sqi_v2_results.sqi) as sqi_count,
+        count(tokenizer_normalized_query) as total_searches
+    from prod_data_science.public.agg_sqi_v2_results
+    join prod_data_hub.answers.searches using(query_id)
+    join prod_product.public.yext_accounts using (business_id)
+    join prod_data_science.public.agg_sqi_v2_by_experience
+        on yext_accounts.business_id = agg_sqi_v2_by_experience.business_id
+        and searches.experience_key = agg_sqi_v2_by_experience.experience_key
+        and year(searches.timestamp) = agg_sqi_v2_by_experience.year
+        and month(searches.timestamp) = agg_sqi_v2_by_experience.month
+    where date(searches.timestamp) >= %(start)s
+    and yext_accounts.business_name = %(business)s
+    and searches.experience_key = %(experience)s
+    group by 1, 2, 3, 4, 5
+    """
 
-# Filter down to experiences that correspond to a given business once a user selects one
-def filter_experiences(df, business):
-    df_filtered = df[df["business_name"] == business]
-    return df_filtered
 
+# Query level SQI for several business and experience pairs at once, with each experience's average in its own
+# partition. The pair list placeholder is filled in by build_query_level_sql_many
+MULTI_QUERY = """
+    select
+        searches.tokenizer_normalized_query as query,
+        yext_accounts.business_id,
+        yext_accounts.business_name,
+        searches.experience_key,
+        avg(agg_sqi_v2_results.sqi) as query_sqi_score,
+        avg(query_sqi_score) over (partition by yext_accounts.business_id, searches.experience_key)
+            as avg_experience_sqi,
+        count(tokenizer_normalized_query) as total_searches,
+        case
+            when round(avg(agg_sqi_v2_results.sqi),2) < round(avg_experience_sqi,2) then 'Below Average'
+            when round(avg(agg_sqi_v2_results.sqi),2) = round(avg_experience_sqi,2) then 'Average'
+            else 'Above Average' end as performance
+    from prod_data_science.public.agg_sqi_v2_results
+    join prod_data_hub.answers.searches using(query_id)
+    join prod_product.public.yext_accounts using (business_id)
+    join prod_data_science.public.agg_sqi_v2_by_experience
+        on yext_accounts.business_id = agg_sqi_v2_by_experience.business_id
+        and searches.experience_key = agg_sqi_v2_by_experience.experience_key
+        and year(searches.timestamp) = agg_sqi_v2_by_experience.year
+        and month(searches.timestamp) = agg_sqi_v2_by_experience.month
+    where date(searches.timestamp) >= dateadd('day', -%(lookback)s, current_date())
+    and (yext_accounts.business_name, searches.experience_key) in ({pairs})
+    group by 1, 2, 3, 4
+    order by 3, 4, 7 desc
+    """
+
+# Approximate query level SQI from a sample of the experience's searches, for a quick preview of the worst queries
+# Searches are scaled up by the sampling rate. Errors are standard errors: of the mean SQI for scores, and of a
+# binomial count for searches. The searches threshold is an approximate percentile of the scaled searches
+PREVIEW_QUERY = """
+    with sampled as (
+        select
+            searches.tokenizer_normalized_query as query,
+            agg_sqi_v2_results.sqi
+        from prod_data_hub.answers.searches sample system (%(sample_percent)s)
+        join prod_data_science.public.agg_sqi_v2_results using(query_id)
+        join prod_product.public.yext_accounts using (business_id)
+        join prod_data_science.public.agg_sqi_v2_by_experience
+            on yext_accounts.business_id = agg_sqi_v2_by_experience.business_id
+            and searches.experience_key = agg_sqi_v2_by_experience.experience_key
+            and year(searches.timestamp) = agg_sqi_v2_by_experience.year
+            and month(searches.timestamp) = agg_sqi_v2_by_experience.month
+        where date(searches.timestamp) >= dateadd('day', -%(lookback)s, current_date())
+        and yext_accounts.business_name = %(business)s
+        and searches.experience_key = %(experience)s
+    ),
+    queries as (
+        select
+            query,
+            avg(sqi) as query_sqi_score,
+            coalesce(stddev_samp(sqi), 0) / sqrt(count(sqi)) as query_sqi_error,
+            count(query) * 100 / %(sample_percent)s as total_searches,
+            sqrt(count(query)) * 100 / %(sample_percent)s as total_searches_error
+        from sampled
+        group by 1
+    )
+    select
+        query,
+        query_sqi_score,
+        query_sqi_error,
+        total_searches,
+        total_searches_error,
+        avg(query_sqi_score) over () as avg_experience_sqi,
+        coalesce(stddev_samp(query_sqi_score) over (), 0) / sqrt(count(query) over ()) as avg_experience_sqi_error,
+        approx_count_distinct(query) over () as sampled_queries,
+        approx_percentile(total_searches, %(percentile)s) over () as min_searches
+    from queries
+    qualify total_searches >= round(min_searches)
+    order by query_sqi_score asc, total_searches desc
+    limit %(limit)s
+    """
 
-def filter_businessid(df, business):
-    business_id = df.loc[df["business_name"] == business, "business_id"].values[0]
-    return business_id
+# Percentage of the experience's searches sampled by the preview
+PREVIEW_SAMPLE_PERCENT = float(os.getenv("SQI_PREVIEW_SAMPLE_PERCENT", "5"))
+# Number of worst queries shown by the preview
+PREVIEW_ROWS = 100
+# Errors of the preview are shown as the half width of a 95% confidence interval
+PREVIEW_Z = 1.96
+
+# Maximum number of business and experience pairs fetched by a single query
+PAIRS_PER_QUERY = 50
+
+# API key of every business, one per business. Small enough to load whole, so businesses never need to be listed
+API_KEYS_QUERY = """
+    select business_id, min(api_key) as api_key
+    from prod_product.public.search_api_keys
+    group by business_id
+    """
+
+# Warehouse statistics of queries run in the current session, looked up by query ID
+QUERY_HISTORY_QUERY = """
+    select
+        query_id,
+        warehouse_size,
+        bytes_scanned,
+        partitions_scanned,
+        partitions_total,
+        rows_produced,
+        compilation_time,
+        queued_overload_time,
+        execution_time,
+        total_elapsed_time
+    from table(information_schema.query_history_by_session(result_limit => 10000))
+    where query_id in ({query_ids})
+    """
+
+# Keep only queries at or above the searches percentile, computed over every query of the experience. Rounds like
+# processing.ViewIndex.min_searches, halves away from zero
+PERCENTILE_CLAUSE = """
+    qualify count(tokenizer_normalized_query)
+        >= round(percentile_cont(%(percentile)s) within group (order by count(tokenizer_normalized_query)) over ())
+    """
+
+# Order by clauses for each of the table sort orders. Sort orders can't be bound, so only these are allowed
+SORT_CLAUSES = {
+    "By SQI (Ascending)": "order by query_sqi_score asc, total_searches desc",
+    "By Searches (Descending)": "order by total_searches desc, query_sqi_score asc",
+}
+
+
+# Build the per-day partial aggregates query of an experience for every day >= start, by default the whole window
+# held by a daily query store. Returns the query and its bind parameters
+def build_daily_sql(business, experience, start=None):
+    start = start or date.today() - timedelta(days=aggregates.WINDOW_DAYS)
+    return DAILY_QUERY, {"start": start.isoformat(), "business": business, "experience": experience}
+
+
+# Fetch per-day partial aggregates for every query of an experience, for every day >= start
+@telemetry.traced()
+def daily_query_sqi(business, experience, start, conn):
+    query, params = build_daily_sql(business, experience, start)
+    df = snowflake.get_data_from_snowflake(query, conn, params=params)
+    return schema.compact_frame(df, schema.DAILY_SCHEMA)
+
+
+# Stores of per-day partial aggregates, one per business and experience, shared between sessions. Held at module
+# level rather than in a Streamlit singleton, so they are shared outside the Streamlit runtime too, e.g. in benchmarks
+_DAILY_QUERY_STORES = aggregates.StoreRegistry()
+
+
+def daily_query_stores() -> aggregates.StoreRegistry:
+    return _DAILY_QUERY_STORES
 
 
 # Return SQI search term dataframe
-@st.experimental_memo()
+# The daily aggregates are fetched once per experience and topped up daily, so any lookback is answered locally
+@telemetry.traced()
 def query_level_sqi(business, experience, lookback, _conn):
-    query = QUERY.format(
-        lookback,
-        business,
-        experience,
+    store = daily_query_stores().get(
+        (business, experience),
+        lambda start, conn: daily_query_sqi(business, experience, start, conn),
     )
-    df = snowflake.get_data_from_snowflake(query, _conn)
+    df = aggregates.rollup_query_sqi(store.frame(_conn), lookback)
     # Round column values to nearest tenth
-    df["avg_experience_sqi"] = df["avg_experience_sqi"].round(2)
-    df["query_sqi_score"] = df["query_sqi_score"].round(2)
+    df["avg_experience_sqi"] = schema.round_half_away(df["avg_experience_sqi"], 2)
+    df["query_sqi_score"] = schema.round_half_away(df["query_sqi_score"], 2)
+    df = schema.compact_frame(df, schema.QUERY_LEVEL_SCHEMA)
+    LOGGER.info("Query level SQI for %s / %s: %s", business, experience, schema.memory_report(df))
     return df
 
 
+# Whether the per-day partial aggregates of an experience are already held in memory, so query_level_sqi is quick
+def query_level_sqi_loaded(business, experience) -> bool:
+    store = daily_query_stores().peek((business, experience))
+    return store is not None and store.loaded is not None
+
+
+@telemetry.traced()
+def preview_query_sqi(
+    business, experience, lookback, percentile, conn, sample_percent=PREVIEW_SAMPLE_PERCENT, limit=PREVIEW_ROWS
+):
+    """
+    Approximate query level SQI for the `limit` lowest SQI queries at or above the searches percentile, from a
+    `sample_percent` sample of the searches. Error columns are 95% confidence half widths.
+    """
+    params = {
+        "sample_percent": float(sample_percent),
+        "lookback": int(lookback),
+        "business": business,
+        "experience": experience,
+        "percentile": float(percentile),
+        "limit": int(limit),
+    }
+    df = snowflake.get_data_from_snowflake(PREVIEW_QUERY, conn, params=params)
+    for column in ["query_sqi_error", "total_searches_error", "avg_experience_sqi_error"]:
+        df[column] = df[column] * PREVIEW_Z
+    return df.round(2)
+
+
+# Memory used by the per-day partial aggregates of each experience held in the daily query stores
+def daily_store_memory_report() -> pd.DataFrame:
+    rows = []
+    for (business, experience), store in daily_query_stores().items():
+        if store.loaded is not None:
+            report = schema.memory_report(store.loaded)
+            rows.append(
+                {"business": business, "experience": experience, "rows": report["rows"], "bytes": report["bytes"]}
+            )
+    return pd.DataFrame(rows, columns=["business", "experience", "rows", "bytes"])
+
+
+# Build a standalone query level SQI query, with the searches threshold, sort order and row limit applied in
+# Snowflake. Used by the evaluation runner and shown for users to run themselves. The app's pages load DAILY_QUERY
+# instead and apply these locally
+# Returns the query and its bind parameters
+def build_query_level_sql(business, experience, lookback, percentile=None, sort_index=None, limit=None):
+    query = QUERY
+    params = {"lookback": int(lookback), "business": business, "experience": experience}
+    if percentile is not None:
+        query += PERCENTILE_CLAUSE
+        params["percentile"] = float(percentile)
+    query += SORT_CLAUSES.get(sort_index, "order by total_searches desc")
+    if limit is not None:
+        query += "\n    limit %(limit)s"
+        params["limit"] = int(limit)
+    return query, params
+
+
+# Build the query level SQI query for a list of (business, experience) pairs, with a bind parameter for every value
+def build_query_level_sql_many(pairs, lookback):
+    params = {"lookback": int(lookback)}
+    placeholders = []
+    for i, (business, experience) in enumerate(pairs):
+        params[f"business_{i}"] = business
+        params[f"experience_{i}"] = experience
+        placeholders.append(f"(%(business_{i})s, %(experience_{i})s)")
+    return MULTI_QUERY.replace("{pairs}", ", ".join(placeholders)), params
+
+
+# Summary of each experience's query level SQI
+def experience_rollup(df) -> pd.DataFrame:
+    grouped = df.groupby(["business_name", "experience_key"], sort=True)
+    rollup = grouped.agg(
+        business_id=("business_id", "first"),
+        avg_experience_sqi=("avg_experience_sqi", "first"),
+        total_searches=("total_searches", "sum"),
+        queries=("query", "size"),
+        below_average_queries=("performance", lambda performance: (performance == "Below Average").sum()),
+    )
+    # Average SQI weighted by the searches of each query
+    weighted = (df["query_sqi_score"] * df["total_searches"]).groupby([df["business_name"], df["experience_key"]]).sum()
+    rollup["search_weighted_sqi"] = (weighted / rollup["total_searches"]).round(2)
+    rollup["avg_experience_sqi"] = rollup["avg_experience_sqi"].round(2)
+    return rollup.reset_index()
+
+
+@telemetry.traced()
+def query_level_sqi_many(pairs, lookback, conn, pairs_per_query=PAIRS_PER_QUERY):
+    """
+    Query level SQI for many (business, experience) pairs, fetched in one query per `pairs_per_query` pairs
+    instead of one per pair. The chunks are fetched at the same time.
+    Returns a dict of each pair to its frame, compacted like query_level_sqi, and a rollup with a row per experience.
+    """
+    pairs = list(dict.fromkeys(tuple(pair) for pair in pairs))
+    if not pairs:
+        return {}, pd.DataFrame()
+    calls = {}
+    for i in range(0, len(pairs), pairs_per_query):
+        query, params = build_query_level_sql_many(pairs[i : i + pairs_per_query], lookback)
+        calls[i] = (snowflake.get_data_from_snowflake, query, conn, params)
+    results = snowflake.run_concurrently(calls)
+    df = pd.concat([results[i] for i in sorted(results)], ignore_index=True)
+    df["avg_experience_sqi"] = schema.round_half_away(df["avg_experience_sqi"], 2)
+    df["query_sqi_score"] = schema.round_half_away(df["query_sqi_score"], 2)
+    frames = {
+        pair: schema.compact_frame(frame.reset_index(drop=True), schema.QUERY_LEVEL_SCHEMA)
+        for pair, frame in df.groupby(["business_name", "experience_key"], sort=False)
+    }
+    # Pairs without any searches in the lookback get an empty frame
+    empty = schema.compact_frame(df.iloc[:0], schema.QUERY_LEVEL_SCHEMA)
+    return {pair: frames.get(pair, empty) for pair in pairs}, experience_rollup(df)
+
+
+# Fetch per-day partial aggregates of SQI across every experience, for every day >= start
+@telemetry.traced()
+def daily_global_sqi(start, conn):
+    return snowflake.get_data_from_snowflake(GLOBAL_DAILY_QUERY, conn, params={"start": start.isoformat()})
+
+
+# Store of the daily global SQI series, computed once and topped up daily, shared between sessions
+_GLOBAL_SQI_STORE = aggregates.DailyAggregateStore(daily_global_sqi)
+
+
+def global_sqi_store() -> aggregates.DailyAggregateStore:
+    return _GLOBAL_SQI_STORE
+
+
+# Empty every store of per-day partial aggregates, so the next loads fetch from Snowflake again
+def clear_stores():
+    _DAILY_QUERY_STORES.clear()
+    _GLOBAL_SQI_STORE.clear()
+
+
 # Load a dataframe containing the global SQI for a given lookback period
+@telemetry.traced()
 def global_sqi(lookback, conn):
-    query = BUSINESS_QUERY.format(lookback)
-    result = snowflake.get_data_from_snowflake(query, conn)
+    result = aggregates.rollup_global_sqi(global_sqi_store().frame(conn), lookback)
     result = round(result, 2)
     return result
 
 
-# Return raw data query
-def return_query(query, business, experience, lookback):
-    query = query.format(
-        lookback,
-        business,
-        experience,
-    )
-    return query
+# Fetch the API key of every business in one query, as a dict of business ID to API key
+# Never cached, since the result cache would keep the keys on disk in plain text
+@telemetry.traced()
+def get_api_keys(conn) -> dict:
+    keys = snowflake.get_data_from_snowflake(API_KEYS_QUERY, conn, use_cache=False)
+    return dict(zip(keys["business_id"].astype(int), keys["api_key"]))
+
+
+# Fetch bytes scanned, partitions pruned and time spent per stage for queries of this session from the query history
+# Never cached, since the history of a query is only complete once it has finished
+def warehouse_stats(query_ids, conn) -> pd.DataFrame:
+    query_ids = [query_id for query_id in dict.fromkeys(query_ids) if query_id]
+    if not query_ids:
+        return pd.DataFrame()
+    params = {f"query_id_{i}": query_id for i, query_id in enumerate(query_ids)}
+    placeholders = ", ".join(f"%({name})s" for name in params)
+    query = QUERY_HISTORY_QUERY.replace("{query_ids}", placeholders)
+    return snowflake.get_data_from_snowflake(query, conn, params=params, use_cache=False)
+
+
+# Return raw data query, with the bind parameters filled in so it can be copied and run by hand
+def return_query(query, params):
+    literals = {
+        key: "'{}'".format(str(value).replace("'", "''")) if isinstance(value, str) else str(value)
+        for key, value in params.items()
+    }
+    return query % literals
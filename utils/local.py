@@ -0,0 +1,261 @@
+import copy
+import itertools
+import json
+import re
+import uuid
+from types import SimpleNamespace
+
+import pyarrow as pa
+
+# Databases and schemas of the Snowflake tables queried by the app, recreated in the local engine
+SCHEMAS = {
+    "prod_data_science": "public",
+    "prod_data_hub": "answers",
+    "prod_product": "public",
+}
+# Snowflake functions used by the app's queries that DuckDB doesn't have
+MACROS = [
+    "create or replace macro dateadd(part, n, d) as cast(d + cast(n::varchar || ' ' || part as interval) as date)",
+]
+# Rows per Arrow batch returned by LocalCursor.fetch_arrow_batches
+BATCH_ROWS = 100_000
+# pyformat bind parameters, e.g. %(business)s, which DuckDB takes as $business
+PARAM_PATTERN = re.compile(r"%\((\w+)\)s")
+
+# Synthetic searches are spread over this many businesses and experiences, and this many distinct queries per
+# experience, with a long tail of rarely searched queries
+BUSINESSES = 5
+EXPERIENCES_PER_BUSINESS = 2
+QUERIES_PER_EXPERIENCE = 50_000
+# Days of synthetic searches, ending today. Covers the maximum lookback of the app
+DAYS = 30
+
+
+class LocalCursor:
+    """
+    Cursor over a DuckDB connection with the parts of the Snowflake cursor API used by utils/snowflake.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection.db.cursor()
+        self._result = None
+        self.sfqid = None
+
+    @property
+    def description(self):
+        return self._result.description if self._result is not None else None
+
+    def execute(self, query, params=None):
+        self._result = self._cursor.execute(PARAM_PATTERN.sub(r"$\1", query), params or {})
+        self.sfqid = "local-{}".format(next(self._ids))
+        return self
+
+    # Local queries are run straight away, so there is never anything left to wait for
+    def execute_async(self, query, params=None):
+        return self.execute(query, params)
+
+    def get_results_from_sfqid(self, query_id):
+        pass
+
+    def fetch_arrow_batches(self):
+        reader = self._result.fetch_record_batch(BATCH_ROWS)
+        for batch in reader:
+            yield pa.Table.from_batches([batch])
+
+    def close(self):
+        self._cursor.close()
+
+
+class LocalConnection:
+    """
+    Local stand-in for a Snowflake connection, backed by an in-memory DuckDB database holding the tables the app
+    queries under their Snowflake names. Can be passed anywhere the app takes a connection.
+    """
+
+    def __init__(self, db=None):
+        # DuckDB is only needed to run the app locally, so it isn't a dependency of the app itself
+        import duckdb
+
+        self.db = db or duckdb.connect()
+        self._closed = False
+        for database, schema in SCHEMAS.items():
+            self.db.execute(f"attach if not exists ':memory:' as {database}")
+            self.db.execute(f"create schema if not exists {database}.{schema}")
+        for macro in MACROS:
+            self.db.execute(macro)
+
+    def cursor(self) -> LocalCursor:
+        return LocalCursor(self)
+
+    def get_query_status_throw_if_error(self, query_id):
+        return "SUCCESS"
+
+    def is_still_running(self, status) -> bool:
+        return False
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        self.db.close()
+
+
+# Uniform value in [0, 1) derived from a row number, so the data is the same for a seed however DuckDB parallelizes
+def _uniform(column: str, salt: int) -> str:
+    return f"(hash({column}, {salt}) % 1000000) / 1000000.0"
+
+
+def create_tables(
+    conn: LocalConnection,
+    searches: int,
+    businesses: int = BUSINESSES,
+    experiences_per_business: int = EXPERIENCES_PER_BUSINESS,
+    queries_per_experience: int = QUERIES_PER_EXPERIENCE,
+    days: int = DAYS,
+    seed: int = 0,
+):
+    """
+    Fills a local connection with synthetic yext_accounts, search_api_keys, agg_sqi_v2_by_experience, searches and
+    agg_sqi_v2_results tables holding `searches` searches over the last `days` days. The data is generated inside
+    DuckDB, so tens of millions of searches never pass through Python.
+    Business n is named "Business n" and its experiences "experience-1", "experience-2", ...
+    """
+    experiences = businesses * experiences_per_business
+    db = conn.db
+    db.execute(
+        f"""
+        create or replace table prod_product.public.yext_accounts as
+        select range + 1 as business_id, 'Business ' || (range + 1) as business_name
+        from range({businesses})
+        """
+    )
+    db.execute(
+        """
+        create or replace table prod_product.public.search_api_keys as
+        select business_id, 'local-api-key-' || business_id as api_key
+        from prod_product.public.yext_accounts
+        """
+    )
+    db.execute(
+        f"""
+        create or replace table prod_data_science.public.agg_sqi_v2_by_experience as
+        select distinct
+            business_id,
+            'experience-' || (experience + 1) as experience_key,
+            year(day) as year,
+            month(day) as month
+        from prod_product.public.yext_accounts,
+            range({experiences_per_business}) as experiences(experience),
+            range(current_date - {days}, current_date + 1, interval 1 day) as days(day)
+        """
+    )
+    # Query numbers are skewed towards 0 by cubing a uniform value, which gives a few head queries and a long tail
+    db.execute(
+        f"""
+        create or replace table prod_data_hub.answers.searches as
+        select
+            query_id,
+            experience % {businesses} + 1 as business_id,
+            'experience-' || (experience // {businesses} + 1) as experience_key,
+            'search term ' || floor(pow({_uniform("query_id", seed + 1)}, 3) * {queries_per_experience})::bigint
+                as tokenizer_normalized_query,
+            current_date::timestamp
+                - to_days((hash(query_id, {seed + 2}) % {days})::integer)
+                - to_seconds((hash(query_id, {seed + 3}) % 86400)::bigint) as timestamp
+        from (
+            select range as query_id, hash(range, {seed}) % {experiences} as experience
+            from range({searches})
+        )
+        """
+    )
+    # Each query has its own typical SQI, with some noise per search
+    db.execute(
+        f"""
+        create or replace table prod_data_science.public.agg_sqi_v2_results as
+        select
+            query_id,
+            0.8 * ({_uniform("tokenizer_normalized_query", seed + 4)}) + 0.2 * ({_uniform("query_id", seed + 5)})
+                as sqi
+        from prod_data_hub.answers.searches
+        """
+    )
+
+
+class RecordedYextClient:
+    """
+    Stand-in for YextClient that answers searches with recorded responses, falling back to a synthetic response
+    with `entities` results per vertical for queries that weren't recorded. Results have the same attributes as
+    AnswersUniversalResults.
+    """
+
+    def __init__(self, responses: dict = None, entities: int = 10, description_chars: int = 1000):
+        # Maps (query, experience key) to the "response" of a recorded search
+        self.responses = responses or {}
+        self.entities = entities
+        self.description_chars = description_chars
+
+    # Responses recorded by record_responses
+    @classmethod
+    def from_jsonl(cls, path: str, **kwargs):
+        responses = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    responses[(record["query"], record["experience_key"])] = record["response"]
+        return cls(responses, **kwargs)
+
+    def search_answers_universal(self, query, experience_key):
+        response = self.responses.get((query, experience_key))
+        if response is None:
+            response = synthetic_response(query, self.entities, self.description_chars)
+        # Callers modify the response, so every search gets its own copy, with its own IDs like a real search
+        response = copy.deepcopy(response)
+        response["queryId"] = str(uuid.uuid4())
+        raw_response = {"meta": {"uuid": str(uuid.uuid4()), "errors": []}, "response": response}
+        return SimpleNamespace(response=response, raw_response=raw_response, query_id=response["queryId"])
+
+
+# Search each query with a real client and append the responses to a JSONL file readable by RecordedYextClient
+def record_responses(client, queries, experience_key, path):
+    with open(path, "a") as f:
+        for query in queries:
+            response = client.search_answers_universal(query, experience_key).__dict__["response"]
+            f.write(json.dumps({"query": query, "experience_key": experience_key, "response": response}, default=str))
+            f.write("\n")
+
+
+# Universal search response with a Knowledge Graph vertical and a Links vertical of `entities` results each
+def synthetic_response(query, entities: int = 10, description_chars: int = 1000) -> dict:
+    description = (query + " ") * (description_chars // (len(query) + 1) + 1)
+    locations = [
+        {
+            "data": {
+                "id": str(i),
+                "name": f"{query} location {i}",
+                "description": description[:description_chars],
+                "address": {"line1": f"{i} Main Street", "city": "New York"},
+                "c_rating": i % 5,
+            }
+        }
+        for i in range(entities)
+    ]
+    links = [
+        {
+            "htmlTitle": f"{query} page {i}",
+            "link": f"https://example.com/{i}",
+            "htmlSnippet": description[:description_chars],
+        }
+        for i in range(entities)
+    ]
+    return {
+        "businessId": 1,
+        "modules": [
+            {"verticalConfigId": "locations", "queryDurationMillis": 40, "results": locations},
+            {"verticalConfigId": "links", "queryDurationMillis": 25, "results": links},
+        ],
+    }
@@ -0,0 +1,77 @@
+import math
+
+import streamlit as st
+from utils import search, telemetry
+
+PAGE_SIZES = [50, 100, 250, 500]
+# Number of queries loaded into the query picker at a time
+PICKER_BATCH = 100
+
+
+# Rows per page and page number inputs for `total` rows. Returns the position of the page's first row and the page size
+def page_controls(total: int, key: str) -> tuple:
+    col1, col2 = st.columns(2)
+    page_size = col1.selectbox("Rows per page", options=PAGE_SIZES, key=f"{key}_page_size")
+    pages = max(math.ceil(total / page_size), 1)
+    page = col2.number_input("Page", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    return (page - 1) * page_size, page_size
+
+
+# Render one page of an already computed frame, e.g. the cluster view, so only that page is sent to the browser
+def render_paged_frame(df, key: str, noun: str = "rows"):
+    total = len(df.index)
+    start, page_size = page_controls(total, key)
+    page_df = df.iloc[start : start + page_size]
+    with telemetry.span("streamlit.dataframe", rows=len(page_df.index)):
+        st.dataframe(page_df, use_container_width=True)
+    st.caption(f"Showing {noun} {min(start + 1, total)}-{start + len(page_df.index)} of {total}")
+
+
+def render_paged_table(dataset, searches_percentile, sort_index, key="table"):
+    """
+    Renders one page of a dataset's view, so only that page is sent to the browser instead of the whole table.
+    Queries can be searched by substring, prefix or tokens. Without a search the first page is a partial selection
+    of the top rows, so it doesn't wait on a full sort.
+    """
+    index = dataset.index
+    col1, col2 = st.columns([3, 1])
+    term = col1.text_input("Search queries", key=f"{key}_search")
+    mode = col2.selectbox("Match", options=search.SEARCH_MODES, key=f"{key}_mode")
+    if term:
+        all_rows = dataset.rows(searches_percentile, sort_index, term, mode)
+        total = len(all_rows)
+    else:
+        total = index.count_at_least(index.min_searches(searches_percentile))
+    start, page_size = page_controls(total, key)
+    if term:
+        rows = all_rows[start : start + page_size]
+    elif start == 0:
+        rows = index.top_rows(searches_percentile, sort_index, page_size)
+    else:
+        rows = index.rows(searches_percentile, sort_index)[start : start + page_size]
+    with telemetry.span("streamlit.dataframe", rows=len(rows)):
+        st.dataframe(dataset.display.iloc[rows], use_container_width=True)
+    st.caption(f"Showing queries {min(start + 1, total)}-{start + len(rows)} of {total}")
+
+
+def query_picker(dataset, searches_percentile, sort_index, label="Select a query:", key="query_select"):
+    """
+    Searchable query picker over a dataset's view. Only queries matching the search text are offered, loaded
+    PICKER_BATCH at a time. Returns the selected query and the options it was picked from.
+    """
+    col1, col2 = st.columns([3, 1])
+    term = col1.text_input("Search queries", key=f"{key}_search")
+    mode = col2.selectbox("Match", options=search.SEARCH_MODES, key=f"{key}_mode")
+    rows = dataset.rows(searches_percentile, sort_index, term, mode)
+    limit_key = f"{key}_limit"
+    # Start from the first batch again whenever the search or the queries change
+    if st.session_state.get(f"{limit_key}_for") != (term, mode, len(rows)):
+        st.session_state[limit_key] = PICKER_BATCH
+        st.session_state[f"{limit_key}_for"] = (term, mode, len(rows))
+    limit = st.session_state[limit_key]
+    options = list(dataset.display["query"].iloc[rows[:limit]])
+    selected = st.selectbox(label, options=options, key=key)
+    if len(rows) > limit and st.button("Load more queries", key=f"{key}_more"):
+        st.session_state[limit_key] = limit + PICKER_BATCH
+        st.experimental_rerun()
+    return selected, options
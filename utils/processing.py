@@ -1,12 +1,18 @@
+import dataclasses
+
 import numpy as np
+import pandas as pd
+from utils import schema, telemetry
 
 # Return minimum number of searches for an experience given a percentile threshold
+@telemetry.traced()
 def searches_floor(df, col, quantile):
     searches_floor = df[col].quantile(quantile)
     return searches_floor
 
 
 # Sort the display dataframe
+@telemetry.traced()
 def sort_df(df, sort_index):
     if sort_index == "By SQI (Ascending)":
         # sort by SQI descending by default
@@ -16,7 +22,90 @@ def sort_df(df, sort_index):
     return df_sorted
 
 
+class ViewIndex:
+    """
+    Index over a query table for instant threshold and sort changes. The searches column is sorted once, so the
+    minimum searches for a percentile is a lookup, and the row order for each sort order is computed once, so every
+    threshold is a slice or a mask of a precomputed permutation instead of a quantile, a filter and a sort.
+    """
+
+    def __init__(self, df):
+        self.searches = df["total_searches"].to_numpy()
+        self.sqi = df["query_sqi_score"].to_numpy()
+        self.sorted_searches = np.sort(self.searches[~pd.isna(self.searches)])
+        self._orders = {}
+        self._rows = {}
+
+    # Keys sorted ascending for each sort order
+    def _sort_keys(self, sort_index):
+        return -self.searches if sort_index == "By Searches (Descending)" else self.sqi
+
+    # Permutation of every row in the given sort order, computed on first use
+    def order(self, sort_index):
+        if sort_index not in self._orders:
+            rows = np.argsort(self._sort_keys(sort_index), kind="stable")
+            self._orders[sort_index] = (rows, self.searches[rows])
+        return self._orders[sort_index]
+
+    # Same result as searches_floor, linearly interpolated between the two closest sorted values
+    def searches_floor(self, quantile):
+        n = len(self.sorted_searches)
+        if n == 0:
+            return 0
+        position = quantile * (n - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, n - 1)
+        low_value = self.sorted_searches[lower]
+        return low_value + (self.sorted_searches[upper] - low_value) * (position - lower)
+
+    def min_searches(self, quantile) -> int:
+        return int(schema.round_half_away(self.searches_floor(quantile)))
+
+    # Number of queries with at least min_searches searches
+    def count_at_least(self, min_searches) -> int:
+        return len(self.sorted_searches) - int(np.searchsorted(self.sorted_searches, min_searches, side="left"))
+
+    # Positions of the rows at or above the searches percentile, in the given sort order
+    @telemetry.traced()
+    def rows(self, quantile, sort_index):
+        min_searches = self.min_searches(quantile)
+        key = (min_searches, sort_index)
+        if key not in self._rows:
+            rows, searches = self.order(sort_index)
+            if sort_index == "By Searches (Descending)":
+                # Rows above the threshold are the start of the searches order
+                self._rows[key] = rows[: self.count_at_least(min_searches)]
+            else:
+                self._rows[key] = rows[searches >= min_searches]
+        return self._rows[key]
+
+    # Positions of the first k rows of rows(quantile, sort_index). Before the sort order has been computed, only the
+    # k rows are sorted, after a partial selection of them
+    @telemetry.traced()
+    def top_rows(self, quantile, sort_index, k):
+        if sort_index in self._orders:
+            return self.rows(quantile, sort_index)[:k]
+        return top_k(self._sort_keys(sort_index), k, np.flatnonzero(self.searches >= self.min_searches(quantile)))
+
+
+# Positions of the k smallest keys among the candidate positions, in ascending order of key then position, the
+# same rows as the first k of a stable sort. Every candidate tied with the k-th smallest key is kept through the
+# partial selection, so ties are broken by position rather than by wherever argpartition left them
+def top_k(keys, k, candidates):
+    if k <= 0:
+        return candidates[:0]
+    candidate_keys = keys[candidates]
+    if len(candidates) > k:
+        kth = np.partition(candidate_keys, k - 1)[k - 1]
+        # NaN keys sort last, so a NaN k-th key can't be compared against and every candidate is kept
+        if not pd.isna(kth):
+            selected = candidate_keys <= kth
+            candidates, candidate_keys = candidates[selected], candidate_keys[selected]
+    return candidates[np.lexsort((candidates, candidate_keys))][:k]
+
+
 # Given an experience key and query, fetch a result set from the Yext client to preview results and return as a list of dicts.
+@telemetry.traced()
 def return_raw_response(client, query, experience_key):
     # Get raw results from the YextClient
     raw_results = client.search_answers_universal(f"{query}", f"{experience_key}")
@@ -36,57 +125,67 @@ def cleaned_response(dict):
     return response_list
 
 
-# Function to get entity profile fileds for KG results. Returns a list
-def get_all_fields(list):
-    # Initialize empty list of fields
-    fields = []
-    # Get the dictionary containing entity profiles
-    dict = list[0]
-    # Iterate through entity profile fields
-    for key in dict:
-        # Check to see if the field contains the entity data
-        if key == "data":
-            result = dict[key]
-            # Append each entity profile field to the list of fields
-            for x in result:
-                fields.append(x)
-    return fields
-
-
-# Function to get entity profile fields for third-party Links results. Returns a list
-def get_link_fields(list):
-    # Initialize empty list of fields
-    fields = []
-    # Iterate through each field in the Links profile
-    for key in list[0]:
-        fields.append(key)
-    return fields
-
-
-# Function to extract all of the unique profile fields from a list of entity profile fields for a given result
-def unique_fields(list):
-    x = np.array(list)
-    unique_list = np.unique(x)
-    return unique_list
-
-
 def get_card_display(profile: dict, fields: list[str], char_lim: int = 500):
     """
     Renders the fields from the profile of an entity. Applies a limit on the value.
     """
-    display = ""
-    first_field = True
+    parts = []
     for field in fields:
-        value = profile.get(field, "")
-        value = str(value)
-
+        value = str(profile.get(field, ""))
         if char_lim and len(value) > char_lim:
             value = value[:char_lim] + " ..."
+        # The first field is the card's title
+        parts.append(f"{value}\n\n" if parts else f"### {value}\n")
+    return "".join(parts)
 
-        if first_field:
-            display += f"### {value}\n"
-            first_field = False
-        else:
-            display += f"{value}\n\n"
 
-    return display
+@dataclasses.dataclass
+class NormalizedResponse:
+    """
+    A cleaned response in columnar form: one row per (vertical, entity, field, value), plus the entity profiles of
+    each vertical in response order and the union of the fields found on Knowledge Graph and Links entities.
+    """
+
+    vertical: list = dataclasses.field(default_factory=list)
+    entity: list = dataclasses.field(default_factory=list)
+    field: list = dataclasses.field(default_factory=list)
+    value: list = dataclasses.field(default_factory=list)
+    modules: list = dataclasses.field(default_factory=list)
+    fields: list = dataclasses.field(default_factory=list)
+    link_fields: list = dataclasses.field(default_factory=list)
+
+    # Per-vertical table with a row per entity and a column per field
+    def entity_table(self, index: int) -> pd.DataFrame:
+        return pd.DataFrame(self.modules[index][1])
+
+    # Rendered cards for the first `limit` entities of a vertical, or every entity without a limit
+    def cards(self, index: int, fields: list, char_lim: int = 500, limit: int = None) -> list:
+        return [get_card_display(profile, fields, char_lim) for profile in self.modules[index][1][:limit]]
+
+
+# Walk a cleaned response once, collecting every entity field and value of every vertical
+@telemetry.traced()
+def normalize_response(response_list) -> NormalizedResponse:
+    normalized = NormalizedResponse()
+    kg_fields = {}
+    link_fields = {}
+    for module in response_list:
+        vertical = module.get("verticalConfigId", "").title()
+        profiles = []
+        for entity_index, entity in enumerate(module.get("results", [])):
+            # Links results are the profile themselves, Knowledge Graph results keep the profile under "data"
+            if vertical == "Links":
+                profile, vertical_fields = entity, link_fields
+            else:
+                profile, vertical_fields = entity.get("data", {}), kg_fields
+            profiles.append(profile)
+            for name, value in profile.items():
+                normalized.vertical.append(vertical)
+                normalized.entity.append(entity_index)
+                normalized.field.append(name)
+                normalized.value.append(value)
+                vertical_fields[name] = True
+        normalized.modules.append((vertical, profiles))
+    normalized.fields = sorted(kg_fields)
+    normalized.link_fields = sorted(link_fields)
+    return normalized
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from utils import processing, telemetry
+
+LOGGER = logging.getLogger(__name__)
+
+# Where cached Answers API responses are stored
+RESPONSE_CACHE_DIR = os.getenv(
+    "SQI_RESPONSE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sqi-prototype", "responses")
+)
+# How long a cached response is served before the Answers API is called again, in seconds
+RESPONSE_TTL = int(os.getenv("SQI_RESPONSE_TTL", "3600"))
+# Size of the stored payloads past which the least recently used responses are removed
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("SQI_RESPONSE_CACHE_MAX_MB", "256")) * 1024 * 1024
+# Expired and excess responses are cleaned up by a put at most this often, in seconds
+CLEANUP_INTERVAL = 300
+# Payloads written less than this many seconds ago are never treated as orphaned, as their key may not be written yet
+ORPHAN_GRACE = 60
+# Fields of each vertical of a response that differ between searches with the same results. They are dropped, so
+# that identical results share one payload
+PER_SEARCH_MODULE_FIELDS = ["queryDurationMillis"]
+# Experience version searched by processing.return_raw_response
+ANSWERS_VERSION = "PRODUCTION"
+# Number of queries before and after the selected one to fetch in the background
+PREFETCH_NEIGHBOURS = 2
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of Answers API responses, keyed by (API key, experience, query, version).
+    Payloads are stored once, compressed and addressed by the hash of their content, so identical results share a
+    single file. The search's own IDs are kept with the key instead. Each key points at a payload and expires after
+    `ttl` seconds. Expired keys and payloads no key points at are removed, as are the least recently used responses
+    once the payloads grow past max_bytes.
+    """
+
+    def __init__(
+        self, directory: str = RESPONSE_CACHE_DIR, ttl: int = RESPONSE_TTL, max_bytes: int = RESPONSE_CACHE_MAX_BYTES
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "keys"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+
+    # The API key is only ever stored hashed
+    @staticmethod
+    def key(api_key: str, experience_key: str, query: str, version: str = ANSWERS_VERSION) -> str:
+        payload = json.dumps([api_key, experience_key, query, version])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self.directory, "keys", key + ".json")
+
+    def _blob_path(self, content: str) -> str:
+        return os.path.join(self.directory, "blobs", content + ".json.z")
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # Whether a key has a response that hasn't expired yet
+    def fresh(self, key: str) -> bool:
+        try:
+            with open(self._key_path(key)) as f:
+                return time.time() - json.load(f)["created"] <= self.ttl
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._key_path(key)) as f:
+                entry = json.load(f)
+            if time.time() - entry["created"] > self.ttl:
+                self._count(False)
+                return None
+            with open(self._blob_path(entry["content"]), "rb") as f:
+                payload = _join(json.loads(zlib.decompress(f.read())), entry.get("search", {}))
+            # The modification time of a key is when it was last read, for evicting the least recently used
+            os.utime(self._key_path(key))
+        except (FileNotFoundError, ValueError, zlib.error):
+            self._count(False)
+            return None
+        self._count(True)
+        return payload
+
+    # Store a payload and return it as it will be read back from the cache
+    def put(self, key: str, payload: dict) -> dict:
+        stored, search = _split(payload)
+        data = json.dumps(stored, sort_keys=True, default=str).encode("utf-8")
+        content = hashlib.sha256(data).hexdigest()
+        # Only write the payload if no other key has stored the same content already
+        blob_path = self._blob_path(content)
+        if not os.path.exists(blob_path):
+            _write_atomic(blob_path, zlib.compress(data))
+        entry = json.dumps({"content": content, "created": time.time(), "search": search}, default=str).encode("utf-8")
+        _write_atomic(self._key_path(key), entry)
+        with self._lock:
+            cleanup = time.time() - self._last_cleanup > CLEANUP_INTERVAL
+            if cleanup:
+                self._last_cleanup = time.time()
+        if cleanup:
+            self.cleanup()
+        return _join(json.loads(data), search)
+
+    def cleanup(self):
+        """
+        Removes expired keys, then the least recently used keys until the payloads they point at fit in max_bytes,
+        then every payload no remaining key points at.
+        """
+        now = time.time()
+        keys = []
+        for name in os.listdir(os.path.join(self.directory, "keys")):
+            path = os.path.join(self.directory, "keys", name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                accessed = os.path.getmtime(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            if now - entry["created"] > self.ttl:
+                _remove(path)
+            else:
+                keys.append((accessed, path, entry["content"]))
+        sizes = {}
+        for name in os.listdir(os.path.join(self.directory, "blobs")):
+            try:
+                sizes[name[: -len(".json.z")]] = os.path.getsize(os.path.join(self.directory, "blobs", name))
+            except FileNotFoundError:
+                continue
+        # Drop the least recently read keys until the payloads still pointed at fit
+        keys.sort()
+        counts = {}
+        for _, _, content in keys:
+            counts[content] = counts.get(content, 0) + 1
+        total = sum(sizes.get(content, 0) for content in counts)
+        for _, path, content in keys:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            counts[content] -= 1
+            if counts[content] == 0:
+                total -= sizes.get(content, 0)
+                LOGGER.info("Evicted cached response %s", content)
+        for content in sizes:
+            blob_path = self._blob_path(content)
+            if counts.get(content, 0) == 0 and now - _mtime(blob_path) > ORPHAN_GRACE:
+                _remove(blob_path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# A response without its per-search fields, which are queryId and each vertical's queryDurationMillis
+def _strip_response(response: dict) -> dict:
+    response = {field: value for field, value in response.items() if field != "queryId"}
+    if isinstance(response.get("modules"), list):
+        response["modules"] = [
+            {field: value for field, value in module.items() if field not in PER_SEARCH_MODULE_FIELDS}
+            if isinstance(module, dict)
+            else module
+            for module in response["modules"]
+        ]
+    return response
+
+
+def _split(payload: dict):
+    """
+    Splits the attributes of an AnswersUniversalResults into the content shared by every search with the same
+    results, and the IDs of this search: query_id, the response's queryId and the uuid of the raw response's meta.
+    raw_response.response is the same object as response, so it is only stored once.
+    """
+    stored = {field: value for field, value in payload.items() if field != "query_id"}
+    search = {"query_id": payload["query_id"]} if "query_id" in payload else {}
+    response = payload.get("response")
+    if isinstance(response, dict):
+        if "queryId" in response:
+            search["queryId"] = response["queryId"]
+        stored["response"] = _strip_response(response)
+    raw_response = payload.get("raw_response")
+    if isinstance(raw_response, dict):
+        raw_response = dict(raw_response)
+        if raw_response.get("response") is response:
+            del raw_response["response"]
+            raw_response["shares_response"] = True
+        elif isinstance(raw_response.get("response"), dict):
+            raw_response["response"] = _strip_response(raw_response["response"])
+        meta = raw_response.get("meta")
+        if isinstance(meta, dict) and "uuid" in meta:
+            search["uuid"] = meta["uuid"]
+            raw_response["meta"] = {field: value for field, value in meta.items() if field != "uuid"}
+        stored["raw_response"] = raw_response
+    return stored, search
+
+
+# Put the IDs of a search back into its stored content, the reverse of _split
+def _join(stored: dict, search: dict) -> dict:
+    payload = dict(stored)
+    response = payload.get("response")
+    if "query_id" in search:
+        payload["query_id"] = search["query_id"]
+    if "queryId" in search and isinstance(response, dict):
+        response["queryId"] = search["queryId"]
+    raw_response = payload.get("raw_response")
+    if isinstance(raw_response, dict):
+        if raw_response.pop("shares_response", False):
+            raw_response["response"] = response
+        if "uuid" in search and isinstance(raw_response.get("meta"), dict):
+            raw_response["meta"]["uuid"] = search["uuid"]
+    return payload
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Modification time of a file, or now if it has been removed in the meantime
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return time.time()
+
+
+# Write to a temporary file first so readers never see a partially written file
+def _write_atomic(path: str, data: bytes):
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+_CACHE = None
+_EXECUTOR = None
+_IN_FLIGHT = set()
+_LOCK = threading.Lock()
+
+
+# Process-wide response cache, created on first use
+def get_cache() -> ResponseCache:
+    global _CACHE
+    with _LOCK:
+        if _CACHE is None:
+            _CACHE = ResponseCache()
+        return _CACHE
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    with _LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+        return _EXECUTOR
+
+
+# Return the raw response for a query, from the cache if it has been fetched recently, otherwise from the YextClient
+def cached_raw_response(client, api_key, query, experience_key, version=ANSWERS_VERSION):
+    with telemetry.span("responses.cached_raw_response") as current:
+        response_cache = get_cache()
+        key = response_cache.key(api_key, experience_key, query, version)
+        raw_response = response_cache.get(key)
+        current.set(cache="miss" if raw_response is None else "hit")
+        if raw_response is None:
+            raw_response = processing.return_raw_response(client, query, experience_key)
+            # Use the stored copy so callers always get the same JSON types, whether it was cached or not
+            raw_response = response_cache.put(key, raw_response)
+        return raw_response
+
+
+def _prefetch_one(client, api_key, query, experience_key, version, key):
+    try:
+        cached_raw_response(client, api_key, query, experience_key, version)
+    except Exception:
+        LOGGER.exception("Prefetching results for %s failed", query)
+    finally:
+        with _LOCK:
+            _IN_FLIGHT.discard(key)
+
+
+# Fetch the responses for the queries around the selected one in the background, so stepping through them is instant
+def prefetch_neighbours(client, api_key, queries, selected, experience_key, version=ANSWERS_VERSION):
+    queries = list(queries)
+    if selected not in queries:
+        return
+    position = queries.index(selected)
+    neighbours = queries[max(position - PREFETCH_NEIGHBOURS, 0) : position + PREFETCH_NEIGHBOURS + 1]
+    response_cache = get_cache()
+    for query in neighbours:
+        key = response_cache.key(api_key, experience_key, query, version)
+        with _LOCK:
+            if query == selected or key in _IN_FLIGHT or response_cache.fresh(key):
+                continue
+            _IN_FLIGHT.add(key)
+        _executor().submit(_prefetch_one, client, api_key, query, experience_key, version, key)
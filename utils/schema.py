@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Store query text as Arrow strings instead of Python objects
+ARROW_STRINGS = os.getenv("SQI_ARROW_STRINGS", "0") == "1"
+
+PERFORMANCE = pd.CategoricalDtype(["Below Average", "Average", "Above Average"])
+
+# Columns with the same value on every row of a query level SQI frame. They are kept once, in the frame's attrs
+HOISTED_COLUMNS = ["business_name", "business_id", "experience_key", "avg_experience_sqi"]
+
+# Dtypes of the query level SQI frame returned by loading.query_level_sqi
+QUERY_LEVEL_SCHEMA = {
+    "query_sqi_score": "float32",
+    "total_searches": "int32",
+    "performance": PERFORMANCE,
+}
+
+# Dtypes of the per-day partial aggregates held by the daily query stores. Sums stay float64 so they add up exactly
+DAILY_SCHEMA = {
+    "sqi_sum": "float64",
+    "sqi_count": "int32",
+    "total_searches": "int32",
+}
+
+
+def compact_frame(df: pd.DataFrame, schema: dict, hoisted: list = HOISTED_COLUMNS) -> pd.DataFrame:
+    """
+    Moves the hoisted columns into df.attrs, keeping their first value, and converts the other columns to the
+    schema's dtypes. The query column becomes an Arrow string column when SQI_ARROW_STRINGS=1.
+    """
+    attrs = dict(df.attrs)
+    for column in hoisted:
+        if column in df.columns:
+            attrs[column] = df[column].iloc[0] if len(df.index) else None
+    df = df.drop(columns=[column for column in hoisted if column in df.columns])
+    dtypes = {column: dtype for column, dtype in schema.items() if column in df.columns}
+    if ARROW_STRINGS and "query" in df.columns:
+        dtypes["query"] = "string[pyarrow]"
+    df = df.astype(dtypes)
+    df.attrs = attrs
+    return df
+
+
+# Rows and bytes used by a frame, in total and per column
+def memory_report(df: pd.DataFrame) -> dict:
+    usage = df.memory_usage(index=True, deep=True)
+    return {"rows": len(df.index), "bytes": int(usage.sum()), "columns": {k: int(v) for k, v in usage.items()}}
+
+
+# Round halves away from zero like Snowflake's ROUND, so values rounded locally match the app's SQL. Python's round
+# and pandas' round both round halves to even
+def round_half_away(values, decimals: int = 0):
+    scale = 10**decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
@@ -0,0 +1,86 @@
+import re
+
+import numpy as np
+
+SEARCH_MODES = ["Substring", "Prefix", "Tokens"]
+
+# Length of the n-grams indexed for substring search. Shorter search terms fall back to a scan
+NGRAM = 3
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class QuerySearchIndex:
+    """
+    Search index over the query text of a dataset. Prefix search is a binary search over the sorted queries,
+    substring search intersects the posting lists of the term's n-grams and token search intersects the posting
+    lists of its tokens, so lookups don't scan every query. The n-gram and token indexes are built on first use.
+    """
+
+    def __init__(self, queries):
+        self.queries = np.array([str(query).lower() for query in queries], dtype=object)
+        self._sorted_rows = np.argsort(self.queries, kind="stable")
+        self._sorted_queries = self.queries[self._sorted_rows]
+        self._ngrams = None
+        self._tokens = None
+
+    @staticmethod
+    def _postings(keys_by_row) -> dict:
+        postings = {}
+        for row, keys in enumerate(keys_by_row):
+            for key in keys:
+                postings.setdefault(key, []).append(row)
+        return {key: np.array(rows) for key, rows in postings.items()}
+
+    def _intersect(self, postings: dict, keys: set) -> np.ndarray:
+        lists = [postings.get(key) for key in keys]
+        if any(rows is None for rows in lists):
+            return np.array([], dtype=int)
+        lists.sort(key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    # Rows of queries starting with the term
+    def prefix(self, term: str) -> np.ndarray:
+        term = term.lower()
+        start = np.searchsorted(self._sorted_queries, term, side="left")
+        end = np.searchsorted(self._sorted_queries, term + "\uffff", side="left")
+        return np.sort(self._sorted_rows[start:end])
+
+    # Rows of queries containing the term anywhere
+    def substring(self, term: str) -> np.ndarray:
+        term = term.lower()
+        if len(term) < NGRAM:
+            return np.flatnonzero([term in query for query in self.queries])
+        if self._ngrams is None:
+            self._ngrams = self._postings(
+                {query[i : i + NGRAM] for i in range(len(query) - NGRAM + 1)} for query in self.queries
+            )
+        candidates = self._intersect(self._ngrams, {term[i : i + NGRAM] for i in range(len(term) - NGRAM + 1)})
+        # Every n-gram matching doesn't mean they are in the right order, so check the candidates
+        return np.array([row for row in candidates if term in self.queries[row]], dtype=int)
+
+    # Rows of queries containing every token of the term, in any order
+    def tokens(self, term: str) -> np.ndarray:
+        if self._tokens is None:
+            self._tokens = self._postings(set(TOKEN_PATTERN.findall(query)) for query in self.queries)
+        tokens = set(TOKEN_PATTERN.findall(term.lower()))
+        if not tokens:
+            return np.arange(len(self.queries))
+        return self._intersect(self._tokens, tokens)
+
+    def search(self, term: str, mode: str = "Substring") -> np.ndarray:
+        if mode == "Prefix":
+            return self.prefix(term)
+        if mode == "Tokens":
+            return self.tokens(term)
+        return self.substring(term)
+
+
+# Keep only the matching rows of an ordered array of rows, without changing their order
+def filter_rows(rows: np.ndarray, matches: np.ndarray, size: int) -> np.ndarray:
+    mask = np.zeros(size, dtype=bool)
+    mask[matches] = True
+    return rows[mask[rows]]
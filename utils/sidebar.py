@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+
+import streamlit as st
+from utils import catalog
+
+SORT_ORDERS = ["By SQI (Ascending)", "By Searches (Descending)"]
+
+# Default value of each sidebar input, also the session state key that keeps its value between pages
+DEFAULTS = {
+    "lookback": 14,
+    "table_sort_order": SORT_ORDERS[0],
+    "searches_percentile": 0.99,
+}
+
+
+@dataclass
+class Selection:
+    """
+    The inputs selected in the sidebar.
+    """
+
+    lookback: int
+    business_name: str
+    business_id: int
+    experience_key: str
+    table_sort_order: str
+    searches_percentile: float
+
+
+# Keep a selectbox's value in session state only while it is one of the options
+def _keep_option(key, options):
+    if key in st.session_state and st.session_state[key] not in options:
+        del st.session_state[key]
+
+
+def render_sidebar(conn, show_sort_order: bool = True) -> Selection:
+    """
+    Renders the sidebar inputs shared by every page. Inputs keep their values when switching between pages.
+    """
+    # Widget values are dropped when a page doesn't render the widget, so write them back to keep them across pages
+    for key in ["lookback", "business_name", "experience_key", "table_sort_order", "searches_percentile"]:
+        if key in st.session_state:
+            st.session_state[key] = st.session_state[key]
+    for key, value in DEFAULTS.items():
+        st.session_state.setdefault(key, value)
+
+    with st.sidebar:
+        # Number input for lookback period, maximum 30 days
+        st.write("Select a lookback period")
+        lookback = st.number_input(
+            "Lookback Period (Days)",
+            min_value=0,
+            max_value=30,
+            step=1,
+            help="Maximum 30 days",
+            key="lookback",
+        )
+        st.write("Select a business and experience")
+        # Load all options for business selection from the business catalog, loaded once per process and refreshed from Snowflake
+        businesses = catalog.get_catalog(conn)
+        # Business user input
+        _keep_option("business_name", businesses.business_names)
+        business_name = st.selectbox("Business Name", options=businesses.business_names, key="business_name")
+        # User input for experience, from all experiences for the business the user inputted above
+        experiences = businesses.experiences(business_name)
+        _keep_option("experience_key", experiences)
+        experience_key = st.selectbox("Experience Key", options=experiences, key="experience_key")
+        # Allow user to select the sort order of the table. Defaults to SQI ascending
+        if show_sort_order:
+            table_sort_order = st.selectbox(
+                "Table Sort Order",
+                options=SORT_ORDERS,
+                help="Select a column to sort table by. Sort by either SQI (ascending) or searches (descending). Defaults to SQI ascending.",
+                key="table_sort_order",
+            )
+        else:
+            table_sort_order = SORT_ORDERS[0]
+        # Allow user to select the minimum searches threshold for the table, using percentiles. This is to filter out long-tail queries. Defaults to 0.99
+        st.write("Select a search threshold")
+        searches_percentile = st.slider(
+            "Min. Searches Threshold",
+            min_value=0.0,
+            max_value=1.0,
+            step=0.01,
+            help="Select a minimum search volume threshold, represented by percentile of total searches, for queries to view SQI for.",
+            key="searches_percentile",
+        )
+
+    return Selection(
+        lookback=lookback,
+        business_name=business_name,
+        # Fetch the business ID, used to grab the API key for connecting with the Yext Client
+        business_id=businesses.business_id(business_name),
+        experience_key=experience_key,
+        table_sort_order=table_sort_order,
+        searches_percentile=searches_percentile,
+    )
@@ -1,14 +1,54 @@
+import contextvars
 import logging
-from typing import Optional
-from rich.logging import RichHandler
+import os
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+from utils import cache, telemetry
+
+# The Snowflake connector is only imported once a connection is opened, so importing this module stays quick
+if TYPE_CHECKING:
+    from snowflake.connector import SnowflakeConnection
 
-logging.basicConfig(level="INFO", format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
 LOGGER = logging.getLogger(__name__)
 
-import os
-import pandas as pd
-from snowflake.connector import SnowflakeConnection, connect
-from snowflake.connector.errors import DatabaseError
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    # Outside of Streamlit (or on older versions) worker threads don't need a script run context
+    def get_script_run_ctx():
+        return None
+
+    def add_script_run_ctx(thread, ctx=None):
+        return thread
+
+# How often to check on a query submitted asynchronously
+POLL_INTERVAL = 0.1
+# Maximum number of queries run at the same time by run_concurrently
+MAX_CONCURRENT_QUERIES = 8
+# How often an open connection is checked and kept alive, in seconds. Snowflake sessions expire after 4 idle hours
+HEARTBEAT_SECONDS = int(os.getenv("SQI_SNOWFLAKE_HEARTBEAT_SECONDS", str(15 * 60)))
+# Error codes of a session that has expired or whose token was revoked, after which the connection must be reopened
+SESSION_EXPIRED_ERRNOS = {390111, 390112, 390114}
+
+_LOGGING_CONFIGURED = False
+
+
+# Send log records to a Rich console handler. Called once the app starts doing real work, so importing rich doesn't
+# slow down starting the app
+def configure_logging():
+    global _LOGGING_CONFIGURED
+    if _LOGGING_CONFIGURED:
+        return
+    from rich.logging import RichHandler
+
+    logging.basicConfig(level="INFO", format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
+    _LOGGING_CONFIGURED = True
 
 
 def connect_to_snowflake(
@@ -17,14 +57,17 @@ def connect_to_snowflake(
     warehouse: str = "HUMAN_WH",
     snowflake_acct: str = "tw61901.us-east-1",
     role: str = "EVERYONE",
-) -> SnowflakeConnection:
-    snowflake_user = os.getenv("SNOWFLAKE_USER")
-    snowflake_pass = os.getenv("SNOWFLAKE_PASS")
+) -> "SnowflakeConnection":
+    from snowflake.connector import connect
+    from snowflake.connector.errors import DatabaseError
+
+    snowflake_user = snowflake_user or os.getenv("SNOWFLAKE_USER")
+    snowflake_pass = snowflake_pass or os.getenv("SNOWFLAKE_PASS")
     if snowflake_user and snowflake_pass:
-        logging.info("Connecting to Snowflake with Standard Credentials")
+        LOGGER.info("Connecting to Snowflake with Standard Credentials")
         try:
             conn = connect(
-                user="cxi@yext.com",
+                user=snowflake_user,
                 password=snowflake_pass,
                 account=snowflake_acct,
                 warehouse=warehouse,
@@ -32,10 +75,10 @@ def connect_to_snowflake(
             )
             return conn
         except DatabaseError:
-            logging.info("Standard Credentials Failed, Trying Browser Auth")
-            logging.info("Connecting to Snowflake with Browser Auth")
+            LOGGER.info("Standard Credentials Failed, Trying Browser Auth")
+            LOGGER.info("Connecting to Snowflake with Browser Auth")
             conn = connect(
-                user="cxi@yext.com",
+                user=snowflake_user,
                 account=snowflake_acct,
                 warehouse=warehouse,
                 authenticator="externalbrowser",
@@ -46,12 +89,427 @@ def connect_to_snowflake(
         raise ValueError("Missing Snowflake credentials")
 
 
-def get_data_from_snowflake(query: str, conn: Optional[SnowflakeConnection] = None) -> pd.DataFrame:
+# Whether an error means the connection's session has expired and it has to be reopened
+def is_session_expired(error: Exception) -> bool:
+    return getattr(error, "errno", None) in SESSION_EXPIRED_ERRNOS
+
+
+class ManagedConnection:
+    """
+    Snowflake connection that is only opened when the first query needs it, kept alive by a heartbeat and reopened
+    when its session expires or its token is revoked. Can be passed anywhere the app takes a connection.
+    """
+
+    def __init__(self, connect=connect_to_snowflake, heartbeat_seconds: int = HEARTBEAT_SECONDS):
+        self._connect = connect
+        self.heartbeat_seconds = heartbeat_seconds
+        self._conn = None
+        self._heartbeat = None
+        self._lock = threading.Lock()
+
+    # The open connection, opened on first use or after it was closed
+    def connection(self) -> "SnowflakeConnection":
+        with self._lock:
+            if self._conn is None or self._conn.is_closed():
+                start = time.perf_counter()
+                self._conn = self._connect()
+                LOGGER.info("Connected to Snowflake in %.2fs", time.perf_counter() - start)
+                if self.heartbeat_seconds and self._heartbeat is None:
+                    self._heartbeat = threading.Thread(target=self._beat, name="snowflake-heartbeat", daemon=True)
+                    self._heartbeat.start()
+            return self._conn
+
+    # Drop the current connection and open a new one
+    def reconnect(self) -> "SnowflakeConnection":
+        with self._lock:
+            stale, self._conn = self._conn, None
+        if stale is not None:
+            try:
+                stale.close()
+            except Exception:
+                LOGGER.debug("Closing the expired Snowflake connection failed", exc_info=True)
+        return self.connection()
+
+    # Run a trivial query every heartbeat_seconds, so the session doesn't expire while the app is idle, and reopen
+    # the connection in the background if it has expired anyway
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._lock:
+                conn = self._conn
+            if conn is None:
+                continue
+            try:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("select 1")
+                finally:
+                    cursor.close()
+            except Exception as error:
+                if not (is_session_expired(error) or conn.is_closed()):
+                    LOGGER.warning("Snowflake heartbeat failed: %s", error)
+                    continue
+                LOGGER.info("Snowflake session expired, reconnecting")
+                try:
+                    self.reconnect()
+                except Exception:
+                    LOGGER.exception("Reconnecting to Snowflake failed")
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+
+    # Everything else, e.g. is_still_running, is passed through to the open connection
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.connection(), name)
+
+
+_CONNECTION = None
+_CONNECTION_LOCK = threading.Lock()
+
+
+# Process-wide managed connection, shared by every session. Nothing is opened until the first query
+def get_connection() -> ManagedConnection:
+    global _CONNECTION
+    with _CONNECTION_LOCK:
+        if _CONNECTION is None:
+            _CONNECTION = ManagedConnection()
+        return _CONNECTION
+
+
+@dataclass
+class FetchStats:
+    """
+    Rows, bytes and wall time of a single fetch, and the Snowflake query ID.
+    """
+
+    query_id: Optional[str] = None
+    rows: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+
+# Lower case column names and turn Snowflake NUMBER columns (fetched as decimals) into plain ints or floats
+def _normalize_batch(table: pa.Table, columns: Optional[list] = None) -> pa.Table:
+    table = table.rename_columns([name.lower() for name in table.column_names])
+    if columns is not None:
+        table = table.select(columns)
+    fields = []
+    for field in table.schema:
+        if pa.types.is_decimal(field.type):
+            field = field.with_type(pa.int64() if field.type.scale == 0 else pa.float64())
+        fields.append(field)
+    return table.cast(pa.schema(fields))
+
+
+class QueryCancelled(Exception):
+    """
+    Raised in place of a result when a query's scope was cancelled or the query ran past its timeout.
+    """
+
+
+class QueryScope:
+    """
+    Tracks the Snowflake queries submitted for one page render, so they can be timed out or cancelled together.
+    Queries fetched in a thread running inside a scope are submitted asynchronously and polled until they finish.
+    """
+
+    def __init__(self, inputs=None, timeout: Optional[float] = None):
+        self.inputs = inputs
+        self.timeout = timeout
+        self.cancelled = False
+        self._running = {}
+        self._children = []
+        self._lock = threading.Lock()
+
+    # Wait for an asynchronously submitted query to finish, cancelling it if it runs past the timeout
+    def wait(self, conn: "SnowflakeConnection", query_id: str):
+        with self._lock:
+            self._running[query_id] = conn
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        try:
+            while conn.is_still_running(conn.get_query_status_throw_if_error(query_id)):
+                if self.cancelled:
+                    raise QueryCancelled(f"Query {query_id} was cancelled")
+                if deadline and time.monotonic() > deadline:
+                    _cancel_query(conn, query_id)
+                    raise QueryCancelled(f"Query {query_id} timed out after {self.timeout}s")
+                time.sleep(POLL_INTERVAL)
+        finally:
+            with self._lock:
+                self._running.pop(query_id, None)
+
+    # Cancel every query still running in this scope and its child scopes
+    def cancel(self):
+        self.cancelled = True
+        with self._lock:
+            running = list(self._running.items())
+            children = list(self._children)
+        for query_id, conn in running:
+            _cancel_query(conn, query_id)
+        for child in children:
+            child.cancel()
+
+    # New scope for queries that can be cancelled on their own, which is also cancelled along with this scope
+    def child(self) -> "QueryScope":
+        child = QueryScope(self.inputs, self.timeout)
+        with self._lock:
+            self._children.append(child)
+        if self.cancelled:
+            child.cancel()
+        return child
 
-    if not conn:
-        conn = connect_to_snowflake()
 
-    df = pd.read_sql(query, conn)
-    df = df.rename(str.lower, axis="columns")
+_SCOPE = threading.local()
 
+
+def _cancel_query(conn: "SnowflakeConnection", query_id: str):
+    LOGGER.info("Cancelling query %s", query_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("select system$cancel_query(%(query_id)s)", {"query_id": query_id})
+    finally:
+        cursor.close()
+
+
+# Run a query on a cursor. Inside a scope the query is submitted asynchronously so it can be timed out or cancelled
+def _execute(cursor, query, params):
+    scope = getattr(_SCOPE, "scope", None)
+    if scope is None:
+        cursor.execute(query, params)
+        return
+    if scope.cancelled:
+        raise QueryCancelled("Query scope was cancelled")
+    cursor.execute_async(query, params)
+    scope.wait(cursor.connection, cursor.sfqid)
+    cursor.get_results_from_sfqid(cursor.sfqid)
+
+
+# Query scope for a page render. If the inputs changed, the previous render's queries are cancelled and a new scope
+# is started. Otherwise the previous scope is kept, so its queries can still be cancelled by a later render
+def query_scope(state, inputs, timeout: Optional[float] = None) -> QueryScope:
+    previous = state.get("query_scope")
+    if previous is not None and previous.inputs == inputs and not previous.cancelled:
+        return previous
+    if previous is not None:
+        previous.cancel()
+    scope = QueryScope(inputs, timeout)
+    state["query_scope"] = scope
+    return scope
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERIES, thread_name_prefix="snowflake")
+        return _EXECUTOR
+
+
+def submit_concurrently(calls: dict, scope: Optional[QueryScope] = None) -> dict:
+    """
+    Starts independent loading calls at the same time, without waiting for them.
+    `calls` maps a name to a tuple of a function and its arguments, e.g. {"global": (loading.global_sqi, 14, conn)}.
+    Returns a dict of the same names to futures.
+    """
+    scope = scope or QueryScope()
+    ctx = get_script_run_ctx()
+
+    def run(fn, *args):
+        # Attach the page's script run context, so Streamlit caching works inside the worker thread
+        add_script_run_ctx(threading.current_thread(), ctx)
+        _SCOPE.scope = scope
+        try:
+            return fn(*args)
+        finally:
+            _SCOPE.scope = None
+
+    # Each call runs in a copy of the caller's context, so its spans are part of the page render's trace
+    return {name: _executor().submit(contextvars.copy_context().run, run, *call) for name, call in calls.items()}
+
+
+# True when Streamlit has asked the script run of `ctx` to rerun or stop, e.g. because an input was changed
+def _rerun_requested(ctx) -> bool:
+    if ctx is None:
+        return False
+    # Newer Streamlit versions keep the script requests on the context, older ones only on the script runner
+    requests = getattr(ctx, "script_requests", None)
+    if requests is None:
+        runner = getattr(getattr(ctx, "_enqueue", None), "__self__", None)
+        requests = getattr(runner, "_requests", None)
+    state = getattr(requests, "_state", None)
+    return state is not None and state.name != "CONTINUE"
+
+
+def wait_for(futures, return_when: str = ALL_COMPLETED):
+    """
+    Waits for futures from submit_concurrently like concurrent.futures.wait, checking every POLL_INTERVAL whether
+    Streamlit wants to rerun or stop the page. If it does, QueryCancelled is raised, so the rerun starts straight
+    away. The queries keep running: the rerun's query_scope cancels them only if the inputs changed, and otherwise
+    the rerun picks up their results.
+    """
+    ctx = get_script_run_ctx()
+    futures = list(futures)
+    while True:
+        done, pending = wait(futures, timeout=POLL_INTERVAL, return_when=return_when)
+        if not pending or (done and return_when == FIRST_COMPLETED):
+            return done, pending
+        if _rerun_requested(ctx):
+            raise QueryCancelled("The page was rerun")
+
+
+# Wait for every future from submit_concurrently and gather their results
+# Any error, timeout or cancellation is raised once every call is done
+def gather(futures: dict) -> dict:
+    wait_for(futures.values())
+    return {name: future.result() for name, future in futures.items()}
+
+
+def run_concurrently(calls: dict, scope: Optional[QueryScope] = None) -> dict:
+    """
+    Runs independent loading calls at the same time and gathers their results.
+    `calls` maps a name to a tuple of a function and its arguments, e.g. {"global": (loading.global_sqi, 14, conn)}.
+    Returns a dict of the same names to results. Any error, timeout or cancellation is raised once every call is done.
+    """
+    return gather(submit_concurrently(calls, scope))
+
+
+# Whole result of a query that already ran on a cursor, fetched row by row, with lower cased column names
+def _rows_frame(cursor, columns: Optional[list] = None) -> pd.DataFrame:
+    names = [column[0].lower() for column in cursor.description or []]
+    df = pd.DataFrame.from_records(cursor.fetchall(), columns=names)
+    return df[columns] if columns is not None else df
+
+
+# Execute a query on a cursor and yield its normalized Arrow result batches
+def _arrow_batches(cursor, query, params, columns, stats) -> Iterator[pa.Table]:
+    start = time.perf_counter()
+    _execute(cursor, query, params)
+    stats.query_id = cursor.sfqid
+    for batch in cursor.fetch_arrow_batches():
+        batch = _normalize_batch(batch, columns)
+        stats.rows += batch.num_rows
+        stats.bytes += batch.nbytes
+        yield batch
+    stats.seconds = time.perf_counter() - start
+
+
+def iter_arrow_batches(
+    query: str,
+    conn: "SnowflakeConnection",
+    params: Optional[dict] = None,
+    columns: Optional[list] = None,
+    stats: Optional[FetchStats] = None,
+) -> Iterator[pa.Table]:
+    """
+    Runs a query and yields the result as Arrow record batches, straight from the connector's Arrow result chunks.
+    Columns are lower cased and optionally projected to `columns`. Rows, bytes and fetch time are added to `stats`.
+    """
+    cursor = conn.cursor()
+    try:
+        yield from _arrow_batches(cursor, query, params, columns, stats if stats is not None else FetchStats())
+    finally:
+        cursor.close()
+
+
+def fetch_arrow_frame(
+    query: str,
+    conn: "SnowflakeConnection",
+    params: Optional[dict] = None,
+    columns: Optional[list] = None,
+    dtypes: Optional[dict] = None,
+    stats: Optional[FetchStats] = None,
+) -> pd.DataFrame:
+    """
+    Runs a query and returns the whole result as a dataframe, built from the Arrow result batches.
+    Columns can be projected with `columns` and converted with a column to dtype mapping in `dtypes`.
+    Statements without Arrow results are fetched row by row from the same cursor, without running them again.
+    """
+    from snowflake.connector.errors import NotSupportedError
+
+    stats = stats if stats is not None else FetchStats()
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        try:
+            batches = list(_arrow_batches(cursor, query, params, columns, stats))
+        except NotSupportedError:
+            # Only fall back once the query has run, it's the Arrow fetch of its result that isn't supported
+            if stats.query_id is None:
+                raise
+            df = _rows_frame(cursor, columns)
+            stats.rows = len(df.index)
+            stats.bytes = int(df.memory_usage(index=False, deep=True).sum())
+            stats.seconds = time.perf_counter() - start
+        else:
+            if batches:
+                df = pa.concat_tables(batches).to_pandas()
+            else:
+                # There are no result batches for an empty result, so build the empty frame from the description
+                names = [column[0].lower() for column in cursor.description or []]
+                df = pd.DataFrame(columns=columns if columns is not None else names)
+    finally:
+        cursor.close()
+    if dtypes:
+        df = df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+    LOGGER.info("Fetched %s rows (%s bytes) in %.2fs", stats.rows, stats.bytes, stats.seconds)
     return df
+
+
+def get_data_from_snowflake(
+    query: str,
+    conn: Optional["SnowflakeConnection"] = None,
+    params: Optional[dict] = None,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+
+    # Logging is set up by the first query rather than on import
+    configure_logging()
+    with telemetry.span("snowflake.get_data_from_snowflake") as current:
+        # Identical queries are served from the shared on-disk cache until the next daily refresh
+        if use_cache:
+            result_cache = cache.get_cache()
+            key = cache.cache_key(query, params)
+            df = result_cache.get(key)
+            if df is not None:
+                current.set(cache="hit", rows=len(df.index))
+                return df
+        current.set(cache="miss" if use_cache else "off")
+
+        if not conn:
+            conn = get_connection()
+
+        # Values are passed as bind parameters (pyformat, e.g. %(business)s) rather than formatted into the query
+        stats = FetchStats()
+        try:
+            df = fetch_arrow_frame(query, conn, params, stats=stats)
+        except Exception as error:
+            # Reopen a managed connection whose session has expired and run the query again
+            if not (is_session_expired(error) and isinstance(conn, ManagedConnection)):
+                raise
+            LOGGER.info("Snowflake session expired, reconnecting")
+            conn.reconnect()
+            stats = FetchStats()
+            df = fetch_arrow_frame(query, conn, params, stats=stats)
+        current.set(query_id=stats.query_id, rows=len(df.index), bytes=stats.bytes, fetch_seconds=stats.seconds)
+
+        if use_cache:
+            # The result is already fetched, so failing to cache it mustn't fail the query
+            try:
+                result_cache.put(key, df)
+                LOGGER.info("Result cache %s", result_cache.stats())
+            except Exception:
+                LOGGER.exception("Caching the result of query %s failed", stats.query_id)
+
+        return df
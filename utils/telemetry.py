@@ -0,0 +1,152 @@
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+# Whether finished spans are written to the log as JSON. Spans are still collected for the debug panel without it
+LOG_SPANS = os.getenv("SQI_TELEMETRY_LOG", "1") == "1"
+
+_IDS = itertools.count(1)
+# The open span and the trace of the current render. Copied into worker threads by snowflake.run_concurrently
+_SPAN = contextvars.ContextVar("sqi_span", default=None)
+_TRACE = contextvars.ContextVar("sqi_trace", default=None)
+
+
+@dataclasses.dataclass
+class Span:
+    """
+    One timed stage of a render, e.g. a Snowflake query or a pandas step, with attributes such as rows and bytes.
+    """
+
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start: float
+    thread: str
+    seconds: float = 0.0
+    attrs: dict = dataclasses.field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def record(self) -> dict:
+        return {
+            "span": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "seconds": round(self.seconds, 6),
+            "thread": self.thread,
+            "error": self.error,
+            **self.attrs,
+        }
+
+
+class Trace:
+    """
+    Every span finished during one page render, in the order they finished.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    # A row per span, in start order, with each span's depth below the top level spans
+    def frame(self) -> pd.DataFrame:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        parents = {span.span_id: span.parent_id for span in spans}
+        rows = []
+        for span in spans:
+            depth, parent = 0, span.parent_id
+            while parent in parents:
+                depth, parent = depth + 1, parents[parent]
+            rows.append(dict(span.record(), depth=depth))
+        return pd.DataFrame(rows)
+
+
+# Start collecting the spans of a page render
+def start_trace(name: str) -> Trace:
+    trace = Trace(name)
+    _TRACE.set(trace)
+    _SPAN.set(None)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _TRACE.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    Times the enclosed block as a span, nested under the span that is open when it starts. Attributes can be added
+    while it runs with span.set(). The finished span is added to the current trace and logged as JSON.
+    """
+    parent = _SPAN.get()
+    current = Span(
+        name,
+        next(_IDS),
+        parent.span_id if parent is not None else None,
+        time.time(),
+        threading.current_thread().name,
+        attrs=attrs,
+    )
+    token = _SPAN.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as error:
+        current.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        _SPAN.reset(token)
+        _finish(current)
+
+
+def _finish(current: Span):
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.add(current)
+    if LOG_SPANS:
+        record = current.record()
+        record["trace_id"] = trace.trace_id if trace is not None else None
+        LOGGER.info(json.dumps(record, default=str))
+
+
+# Decorator timing every call of a function as a span, with the number of rows when it returns a dataframe
+def traced(name: Optional[str] = None):
+    def decorate(fn):
+        span_name = name or "{}.{}".format(fn.__module__.rsplit(".", 1)[-1], fn.__qualname__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name) as current:
+                result = fn(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    current.set(rows=len(result.index))
+                return result
+
+        return wrapper
+
+    return decorate